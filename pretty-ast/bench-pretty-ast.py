@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+import importlib.util
+import io
+import json
+import math
+import os.path
+import platform
+import time
+
+
+def load_pretty_ast():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pretty-ast.py')
+    spec = importlib.util.spec_from_file_location('pretty_ast', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+pa = load_pretty_ast()
+
+
+def gen_deep_lambdas(n):
+    """
+    n lambdas nested into each other, every body maps over the previous arg
+    """
+    body = '$1'
+    for i in range(n):
+        body = "(lambda '($%d) (Map $%d %s))" % (i + 2, i + 2, body)
+    return "(\n(let $1 (Void))\n(return %s)\n)\n" % body
+
+
+def gen_many_lets(n):
+    """
+    n lets in one block, each used twice by the next one
+    """
+    lines = ['(', "(let $1 (DataType 'Int32))"]
+    for i in range(2, n + 1):
+        lines.append("(let $%d (Foo '\"x%d\" $%d $%d))" % (i, i, i - 1, i - 1))
+    lines.append('(return $%d)' % n)
+    lines.append(')')
+    return '\n'.join(lines) + '\n'
+
+
+def gen_shared_refs(n):
+    """
+    n layers of lets, each referencing all of the previous layer three times,
+    so the let graph has exponentially many paths
+    """
+    lines = ['(', "(let $1 (StructType '('\"a\" (DataType 'Int32))))"]
+    for i in range(2, n + 1):
+        lines.append("(let $%d (WideMap $%d (lambda '($%d) $%d) $%d))" % (i, i - 1, n + i, i - 1, i - 1))
+    lines.append('(return $%d)' % n)
+    lines.append(')')
+    return '\n'.join(lines) + '\n'
+
+
+def gen_huge_strings(n):
+    """
+    a handful of string literals of n kilobytes each, with some escapes
+    """
+    chunk = 'abcdefgh' * 127 + '\\"\\\\ab'
+    literal = '"' + chunk * n + '"'
+    lines = ['(']
+    for i in range(1, 5):
+        lines.append("(let $%d (Udf '%s (Void)))" % (i, literal))
+    lines.append("(return '($1 $2 $3 $4))")
+    lines.append(')')
+    return '\n'.join(lines) + '\n'
+
+
+def gen_wide_stages(n):
+    """
+    a physical query with n independent stages
+    """
+    lines = ['(']
+    stages = []
+    for i in range(n):
+        stage = 2 * i + 1
+        arg = 2 * i + 2
+        lines.append("(let $%d (DqPhyStage '() (lambda '($%d) (FromFlow (WideMap (ToFlow $%d) (lambda '($%d) (Member $%d '\"c%d\"))))) "
+                     "'('('\"_logical_id\" '%d))))" % (stage, arg, arg, arg, arg, i, i))
+        stages.append('$%d' % stage)
+    lines.append("(return (KqpPhysicalQuery '((KqpPhysicalTx '(%s) '() '() '('('\"type\" '\"compute\")))) '() '()))" % ' '.join(stages))
+    lines.append(')')
+    return '\n'.join(lines) + '\n'
+
+
+GENERATORS = {
+    'deep_lambdas': (gen_deep_lambdas, [250, 500, 1000, 2000]),
+    'many_lets': (gen_many_lets, [500, 1000, 2000, 4000]),
+    'shared_refs': (gen_shared_refs, [10, 20, 40, 80]),
+    'huge_strings': (gen_huge_strings, [64, 128, 256, 512]),
+    'wide_stages': (gen_wide_stages, [250, 500, 1000, 2000]),
+}
+
+STAGES = ['parse', 'collect_refs', 'replace_refs', 'simplify_blocks', 'print_list']
+
+
+def run_pipeline(text, callables):
+    timings = {}
+
+    start = time.perf_counter()
+    program = pa.parse_buffer(text)
+    timings['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ref_table, ref_counts, _ = pa.collect_refs(program)
+    timings['collect_refs'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    replaced_program = pa.List(False)
+    replaced_program.list, _ = pa.replace_refs(program.list, ref_table, ref_counts)
+    timings['replace_refs'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    simplified_program = pa.List(False)
+    simplified_program.list = pa.simplify_blocks(replaced_program.list)
+    timings['simplify_blocks'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    out = pa.Output(io.StringIO(), True)
+    pa.print_list(out, simplified_program, callables, pa.Context(tabstops=True))
+    out.flush()
+    timings['print_list'] = time.perf_counter() - start
+
+    return timings
+
+
+def scaling_exponent(sizes, times):
+    """
+    Slope of log(time) over log(size): ~1 is linear, ~2 quadratic
+    """
+    points = [(math.log(size), math.log(t)) for size, t in zip(sizes, times) if t > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    if var == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+
+def run_benchmarks(names, repeat, scale, callables):
+    results = {}
+    for name in names:
+        generator, sizes = GENERATORS[name]
+        sizes = [max(1, int(size * scale)) for size in sizes]
+        by_stage = {stage: [] for stage in STAGES}
+        input_bytes = []
+        for size in sizes:
+            text = generator(size)
+            input_bytes.append(len(text))
+            best = None
+            for _ in range(repeat):
+                timings = run_pipeline(text, callables)
+                if best is None:
+                    best = timings
+                else:
+                    best = {stage: min(best[stage], timings[stage]) for stage in STAGES}
+            for stage in STAGES:
+                by_stage[stage].append(best[stage])
+            print('%-14s size %-6d %s' % (name, size, ' '.join('%s=%.4fs' % (stage, best[stage]) for stage in STAGES)),
+                  file=sys.stderr)
+        results[name] = {
+            'sizes': sizes,
+            'input_bytes': input_bytes,
+            'times': by_stage,
+            'exponents': {stage: scaling_exponent(sizes, by_stage[stage]) for stage in STAGES},
+        }
+    return results
+
+
+def print_report(results, baseline, threshold):
+    regressions = 0
+    for name, result in results.items():
+        print('%s (sizes %s)' % (name, ', '.join(str(size) for size in result['sizes'])))
+        for stage in STAGES:
+            times = result['times'][stage]
+            exponent = result['exponents'][stage]
+            line = '    %-16s %s  ~n^%s' % (stage, ' '.join('%9.4f' % t for t in times),
+                                            '%.2f' % exponent if exponent is not None else '?')
+            base = baseline.get(name) if baseline else None
+            if base and base['sizes'] == result['sizes']:
+                base_total = sum(base['times'][stage])
+                total = sum(times)
+                if base_total > 0:
+                    ratio = total / base_total
+                    line += '  x%.2f vs baseline' % ratio
+                    if ratio > 1 + threshold:
+                        line += '  REGRESSION'
+                        regressions += 1
+            print(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark the pretty-ast pipeline stages on synthetic plans')
+    argparser.add_argument('-b', '--bench', default=[], action='append', choices=sorted(GENERATORS),
+                           help='benchmark to run, all by default')
+    argparser.add_argument('-r', '--repeat', type=int, default=3, help='runs per size, the best one is reported')
+    argparser.add_argument('--scale', type=float, default=1.0, help='multiply all input sizes by this factor')
+    argparser.add_argument('-n', '--nodes', default=[], action='append', help='node JSON files for parameter names')
+    argparser.add_argument('--save', default=None, help='store the results as JSON')
+    argparser.add_argument('--compare', default=None, help='compare with results stored by --save')
+    argparser.add_argument('--threshold', type=float, default=0.2,
+                           help='relative slowdown reported as a regression')
+    args = argparser.parse_args()
+
+    callables = pa.load_callables(args.nodes, use_cache=False)
+    names = args.bench or sorted(GENERATORS)
+    results = run_benchmarks(names, args.repeat, args.scale, callables)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'rt') as inf:
+            baseline = json.load(inf)['results']
+    regressions = print_report(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.save, 'wt') as outf:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'scale': args.scale,
+                'results': results,
+            }, outf, indent=2)
+
+    sys.exit(1 if regressions else 0)
@@ -2,7 +2,34 @@
 
 import sys
 import argparse
+import contextlib
+import difflib
+import glob
+import gzip
+import hashlib
+import io
+import itertools
 import json
+import lzma
+import marshal
+import mmap
+import multiprocessing
+import os
+import pickle
+import queue
+import re
+import signal
+import socketserver
+import stat
+import struct
+import threading
+import time
+import tracemalloc
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 COMPLEX_ARGS = {
     'DqCnHashShuffle',
@@ -77,6 +104,8 @@ COLOR_ARG = 'arg'
 COLOR_LAMBDA = COLOR_ARG
 COLOR_REF = None
 COLOR_TABLINE = 'tabline'
+COLOR_REMOVED = 'removed'
+COLOR_ADDED = 'added'
 
 COLORS = {
     COLOR_COMMENT: '2;128;128;128',
@@ -85,34 +114,112 @@ COLORS = {
     COLOR_STRING_LITERAL: '2;64;192;192',
     COLOR_LITERAL: '2;64;192;192',
     COLOR_ARG: '2;192;156;0',
-    COLOR_TABLINE: '2;64;64;64'
+    COLOR_TABLINE: '2;64;64;64',
+    COLOR_REMOVED: '2;192;0;0',
+    COLOR_ADDED: '2;0;160;0'
 }
 
 
-class Color:
-    def __init__(self, color_name):
-        if color_name and (color_name in COLORS) and sys.stdout.isatty():
-            self.color = COLORS[color_name]
+class Output:
+    """
+    Buffered writer for the rendered program. Whether to color is decided once,
+    escape sequences and indentation strings are built once and reused.
+    """
+    COLOR_RESET = '\033[39m'
+
+    def __init__(self, stream, use_color, flush_every=8192):
+        self.stream = stream
+        self.chunks = []
+        self.flush_every = flush_every
+        self.color_prefixes = {}
+        if use_color:
+            for color_name, color in COLORS.items():
+                self.color_prefixes[color_name] = '\033[38;%sm' % color
+        self.newlines = {}
+        self.escaped_strings = {}
+        self.has_deferred = False
+        # printed characters since the last newline, escape sequences excluded
+        self.column = 0
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.column += len(text)
+        if len(self.chunks) >= self.flush_every:
+            self.flush()
+
+    def write_colored(self, color_name, text):
+        prefix = self.color_prefixes.get(color_name)
+        if prefix:
+            self.chunks += (prefix, text, self.COLOR_RESET)
         else:
-            self.color = None
-
-    def __enter__(self):
-        if self.color:
-            sys.stdout.write('\033[38;%sm' % self.color)
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        if self.color:
-            sys.stdout.write('\033[39m')
+            self.chunks.append(text)
+        self.column += len(text)
+        if len(self.chunks) >= self.flush_every:
+            self.flush()
+
+    def newline(self, shift, tabstops):
+        key = (shift, tabstops)
+        text = self.newlines.get(key)
+        if text is None:
+            if tabstops:
+                prefix = self.color_prefixes.get(COLOR_TABLINE)
+                tab = prefix + '\u2506   ' + self.COLOR_RESET if prefix else '\u2506   '
+            else:
+                tab = '    '
+            text = '\n' + tab * max(shift, 0)
+            # the deeply indented ones are rare and big
+            if shift < 256:
+                self.newlines[key] = text
+        self.chunks.append(text)
+        self.column = 4 * max(shift, 0)
+        if len(self.chunks) >= self.flush_every:
+            self.flush()
+
+    def escape_string(self, value):
+        text = self.escaped_strings.get(value)
+        if text is None:
+            text = '"' + value.encode('unicode_escape').decode('utf-8') + '"'
+            self.escaped_strings[value] = text
+        return text
+
+    def write_deferred(self, result):
+        # text rendered by a ParallelRender worker, flush() waits for it
+        self.chunks.append(result)
+        self.has_deferred = True
+
+    def flush(self):
+        if self.has_deferred:
+            self.chunks[:] = [chunk if isinstance(chunk, str) else chunk.get() for chunk in self.chunks]
+            self.has_deferred = False
+        self.stream.write(''.join(self.chunks))
+        self.chunks.clear()
+
+
+def stream_supports_color(stream, mode):
+    if mode == 'always':
+        return True
+    if mode == 'never':
+        return False
+    return stream.isatty()
 
 
 class List:
+    # size, depth and flags are filled in by annotate(), size == 0 means not annotated yet
+    __slots__ = ('list', 'is_quote', 'size', 'depth', 'flags')
+
     def __init__(self, is_quote):
         self.list = []
         self.is_quote = is_quote
+        self.size = 0
+        self.depth = 0
+        self.flags = 0
 
 
+# Elements and References are never mutated, so parse() creates only one
+# instance per distinct atom and shares it between all its occurrences.
 class Element:
+    __slots__ = ('value', 'is_quote', 'is_quoted_str')
+
     def __init__(self, is_quote, value, is_quoted_str=False):
         self.value = value
         self.is_quote = is_quote
@@ -120,6 +227,8 @@ class Element:
 
 
 class Reference:
+    __slots__ = ('alias',)
+
     def __init__(self, alias):
         self.alias = alias
 
@@ -137,6 +246,27 @@ def get_oper(the_list):
     return get_oper_from_raw_list(the_list.list)
 
 
+def walk(walker):
+    """
+    Runs a pass written as a generator: instead of calling itself recursively
+    it yields the walker for a sub-list and gets its return value back.
+    The nesting depth of the program is thus not limited by Python's stack.
+    """
+    stack = [walker]
+    value = None
+    while True:
+        try:
+            sub_walker = stack[-1].send(value)
+        except StopIteration as stop:
+            stack.pop()
+            if not stack:
+                return stop.value
+            value = stop.value
+        else:
+            stack.append(sub_walker)
+            value = None
+
+
 def get_oper_color(oper):
     if not oper:
         return None
@@ -148,20 +278,224 @@ def get_oper_color(oper):
         return COLOR_FUNC_NAME
 
 
+class LambdaArgs:
+    """
+    The lambda arguments in scope, shared by all the Contexts of one print.
+    A lambda binds its arguments once its argument list is printed and
+    unbinds them when it is done. Bindings are counted, so an argument
+    shadowed by a nested lambda stays bound after the nested one is done.
+    """
+    def __init__(self, aliases=()):
+        self.counts = {}
+        self.bind(aliases)
+
+    def __contains__(self, alias):
+        return alias in self.counts
+
+    def bind(self, aliases):
+        for alias in aliases:
+            self.counts[alias] = self.counts.get(alias, 0) + 1
+
+    def unbind(self, aliases):
+        for alias in aliases:
+            count = self.counts[alias] - 1
+            if count:
+                self.counts[alias] = count
+            else:
+                del self.counts[alias]
+
+
 class Context:
-    def __init__(self, parent=None, shift=None, is_lambda_args=False, tabstops=None):
+    def __init__(self, parent=None, shift=None, is_lambda_args=False, tabstops=None, fold=None, layout=None):
         self.shift = 0
-        self.lambda_args = set()
+        self.fold = fold
+        self.layout = layout
+        self.depth = 0
+        self.parallel = None
+        # the arguments printed in a lambda argument list / bound by a lambda
+        self.declared_args = [] if is_lambda_args else None
+        self.bound_args = None
         if parent is not None:
             self.tabstops = parent.tabstops
             self.shift = parent.shift
-            if not is_lambda_args:
-                self.lambda_args.update(parent.lambda_args)
+            self.fold = parent.fold
+            self.layout = parent.layout
+            self.parallel = parent.parallel
+            self.depth = parent.depth + 1
+            self.lambda_args = parent.lambda_args
+        else:
+            self.lambda_args = LambdaArgs()
         if shift is not None:
             self.shift = shift
         if tabstops is not None:
             self.tabstops = tabstops
         self.is_lambda_args = is_lambda_args
+        # closing parens printed right after the list, for Layout
+        self.trailing = 0
+
+    def bind_args(self, aliases):
+        self.lambda_args.bind(aliases)
+        self.bound_args = aliases
+
+
+class Fold:
+    """
+    Decides which lists are printed as a one line summary. Levels are counted
+    from the top level forms (level 1), the list holding them is never folded.
+    """
+    def __init__(self, max_depth=None, larger_than=None, only=None):
+        self.max_depth = max_depth
+        self.larger_than = larger_than
+        self.only = only
+        self.has_only = {}
+
+    def is_folded(self, the_list, level):
+        if level == 1:
+            # lists are remembered by id, which is only safe while the form
+            # holding them is alive: streamed forms are freed once printed
+            self.has_only.clear()
+        # a list without sub-lists takes one line anyway
+        if level < 1 or not any(isinstance(item, List) for item in the_list.list):
+            return False
+        if self.max_depth is not None and level > self.max_depth:
+            return True
+        if self.larger_than is not None and annotate(the_list).size > self.larger_than:
+            return True
+        if self.only is not None and not self.contains_only(the_list):
+            return True
+        return False
+
+    def contains_only(self, the_list):
+        """
+        Whether the_list or any of its sub-lists has one of the --only operators
+        """
+        result = self.has_only.get(id(the_list))
+        if result is not None:
+            return result
+        stack = [(the_list, False)]
+        while stack:
+            item, children_done = stack.pop()
+            if id(item) in self.has_only:
+                continue
+            sub_lists = [sub_item for sub_item in item.list if isinstance(sub_item, List)]
+            if children_done:
+                self.has_only[id(item)] = get_oper(item) in self.only or \
+                    any(self.has_only[id(sub_item)] for sub_item in sub_lists)
+                continue
+            stack.append((item, True))
+            for sub_item in sub_lists:
+                if id(sub_item) not in self.has_only:
+                    stack.append((sub_item, False))
+        return self.has_only[id(the_list)]
+
+
+def get_param_name(child_list, pos):
+    param_name = child_list.get(pos - 1, None)
+    if param_name == 'Input':
+        return '⇐'
+    elif param_name == 'Lambda':
+        return 'λ'
+    return param_name
+
+
+class Layout:
+    """
+    Width aware line breaking used instead of COMPLEX_ARGS: a list is printed
+    on one line when it fits into the rest of the line, otherwise each of its
+    arguments goes to a line of its own and decides the same for itself.
+    One line widths are measured at most once per list and never further
+    than the width limit, so laying out stays linear in the printed size.
+    """
+    # the last argument stays on the line of the operator and breaks on its
+    # own, if all the others and its head fit
+    HANGING = ('let', 'return', 'declare', 'lambda', 'block')
+
+    def __init__(self, width, callables):
+        self.width = width
+        self.callables = callables
+        self.widths = {}
+
+    def breaks(self, the_list, column, trailing, level):
+        """
+        Whether the_list, whose opening paren ends at column and which is
+        followed by trailing closing parens, is split into lines. Levels are
+        counted as in Fold.
+        """
+        if level == 1:
+            # see Fold.is_folded
+            self.widths.clear()
+        if len(the_list.list) <= 1:
+            return False
+        width = self.widths.get(id(the_list))
+        if width is None:
+            width = walk(self.measure_walker(the_list))
+        start = column - (2 if the_list.is_quote else 1)
+        if start + width + trailing <= self.width:
+            return False
+        oper = get_oper(the_list)
+        if oper == 'block':
+            return False
+        for item in the_list.list:
+            # the lists of lets are broken after each of them anyway
+            if isinstance(item, List) and get_oper(item) in ('let', 'return', 'declare'):
+                return False
+        if oper in self.HANGING:
+            last = the_list.list[-1]
+            head = walk(self.measure_walker(the_list, len(the_list.list) - 1)) + 1
+            if isinstance(last, List):
+                head += walk(self.measure_walker(last, 1))
+            else:
+                head += self.atom_width(last) + trailing
+            return start + head > self.width
+        return True
+
+    @staticmethod
+    def atom_width(item):
+        if isinstance(item, Reference):
+            return 1 + len(str(item.alias))
+        width = 1 if item.is_quote else 0
+        if item.is_quoted_str:
+            # as escaped by Output.escape_string()
+            return width + len(item.value.encode('unicode_escape')) + 2
+        return width + len(str(item.value))
+
+    def measure_walker(self, the_list, count=None):
+        """
+        The width of the_list, or of its first count items, printed on one line,
+        or width + 1 if it is wider
+        """
+        if count is None:
+            width = self.widths.get(id(the_list))
+            if width is not None:
+                return width
+        limit = self.width + 1
+        oper = get_oper(the_list)
+        width = 3 if the_list.is_quote else 2
+        if count is None and oper in ('let', 'return', 'declare', 'block'):
+            # always takes more than one line
+            width = limit
+        child_list = {}
+        if oper and oper in self.callables:
+            child_list = self.callables[oper].children_names
+        for pos, item in enumerate(itertools.islice(the_list.list, count)):
+            if width >= limit:
+                break
+            if pos > 0:
+                width += 1
+                param_name = get_param_name(child_list, pos)
+                if param_name:
+                    width += len(param_name) + 2
+            if isinstance(item, List):
+                item_width = self.widths.get(id(item))
+                if item_width is None:
+                    item_width = yield self.measure_walker(item)
+                width += item_width
+            else:
+                width += self.atom_width(item)
+        width = min(width, limit)
+        if count is None:
+            self.widths[id(the_list)] = width
+        return width
 
 
 def get_is_long_oper(the_list: List):
@@ -171,28 +505,200 @@ def get_is_long_oper(the_list: List):
     return oper is not None and (oper in COMPLEX_ARGS)
 
 
-def has_long_or_block_oper_inside(item):
-    if isinstance(item, List):
-        if get_is_long_oper(item) or get_oper(item) == 'block':
-            return True
+HAS_LONG_OR_BLOCK = 1
+HAS_REFS = 2
+IS_SIMPLE = 4
+
+
+def annotate_list(the_list):
+    items = the_list.list
+    oper = get_oper(the_list)
+    is_let = oper == 'let' and len(items) > 2 and isinstance(items[1], Reference)
+
+    size = 1
+    depth = 0
+    flags = 0
+    all_simple = IS_SIMPLE
+    if get_is_long_oper(the_list) or oper == 'block':
+        flags |= HAS_LONG_OR_BLOCK
+    for pos, item in enumerate(items):
+        if isinstance(item, List):
+            size += item.size
+            if item.depth > depth:
+                depth = item.depth
+            flags |= item.flags & (HAS_LONG_OR_BLOCK | HAS_REFS)
+            all_simple &= item.flags
+        else:
+            size += 1
+            # the name of a let is not a use of it
+            if isinstance(item, Reference) and not (is_let and pos == 1):
+                flags |= HAS_REFS
+
+    if oper == 'lambda' and len(items) > 1 and isinstance(items[1], List):
+        lambda_args = set()
+        for sub_item in items[1].list:
+            if isinstance(sub_item, Reference):
+                lambda_args.add(sub_item.alias)
+        for def_item in items[2:]:
+            if not isinstance(def_item, Reference) or def_item.alias not in lambda_args:
+                break
+        else:
+            flags |= IS_SIMPLE
+    elif oper is None:
+        flags |= all_simple
+    elif oper in SIMPLE_OPERATORS:
+        flags |= IS_SIMPLE
+
+    the_list.size = size
+    the_list.depth = depth + 1
+    the_list.flags = flags
+
+
+def annotate(the_list):
+    """
+    Post-order pass caching facts about each sub-list: node count, depth and
+    the HAS_LONG_OR_BLOCK / HAS_REFS / IS_SIMPLE flags. Already annotated
+    sub-lists (shared after replace_refs) are not visited again.
+    """
+    if the_list.size:
+        return the_list
+    stack = [(the_list, False)]
+    while stack:
+        item, children_done = stack.pop()
+        if item.size:
+            continue
+        if children_done:
+            annotate_list(item)
+            continue
+        stack.append((item, True))
         for sub_item in item.list:
-            if has_long_or_block_oper_inside(sub_item):
-                return True
-    else:
-        return False
+            if isinstance(sub_item, List) and not sub_item.size:
+                stack.append((sub_item, False))
+    return the_list
 
 
-def print_list(out, the_list: List, callables, context: Context):
-    def print_shift(sh):
-        for _ in range(sh):
-            if context.tabstops:
-                with Color(COLOR_TABLINE):
-                    out.write('\u2506   ')
+def has_long_or_block_oper_inside(item):
+    return isinstance(item, List) and bool(annotate(item).flags & HAS_LONG_OR_BLOCK)
+
+
+def print_folded(out, the_list, context):
+    # the leading atoms are kept, the rest is summarized
+    oper = get_oper(the_list)
+    for pos, item in enumerate(the_list.list):
+        if isinstance(item, List):
+            break
+        if isinstance(item, Reference):
+            color = COLOR_ARG if item.alias in context.lambda_args else COLOR_REF
+            out.write_colored(color, '$' + str(item.alias))
+        else:
+            if item.is_quote:
+                out.write_colored(COLOR_LITERAL, '\'')
+            if item.is_quoted_str:
+                out.write_colored(COLOR_STRING_LITERAL, out.escape_string(item.value))
             else:
-                out.write('    ')
+                out.write_colored(get_oper_color(oper) if pos == 0 else COLOR_LITERAL, str(item.value))
+        out.write(' ')
+    out.write_colored(COLOR_COMMENT, '⦗… %d nodes⦘' % annotate(the_list).size)
+
+
+render_state = {}
+
+
+def render_chunk(index, shift, depth, lambda_args):
+    """
+    Runs in a ParallelRender worker, which got the program when forked
+    """
+    out = Output(io.StringIO(), render_state['use_color'])
+    context = Context(shift=shift, tabstops=render_state['tabstops'], fold=render_state['fold'])
+    context.depth = depth
+    context.lambda_args.bind(lambda_args)
+    walk(print_list_walker(out, render_state['chunks'][index], render_state['callables'], context))
+    out.flush()
+    return out.stream.getvalue()
+
+
+class ParallelRender:
+    """
+    Renders large independent sub-lists of a program in forked worker
+    processes. print_list_walker() submits them with their context as it
+    meets them and Output stitches the results back in order, so the output
+    is the same as when rendering serially.
+    """
+    MIN_CHUNK_SIZE = 1000
+
+    def __init__(self, program, callables, context, use_color, jobs):
+        self.pool = None
+        self.chunk_indices = {}
+        total = annotate(program).size
+        max_size = max(total // (jobs * 8), self.MIN_CHUNK_SIZE)
+        chunks = []
+        seen = set()
+        stack = [program]
+        while stack:
+            item = stack.pop()
+            for sub_item in item.list:
+                if not isinstance(sub_item, List) or id(sub_item) in seen:
+                    continue
+                seen.add(id(sub_item))
+                if sub_item.size > max_size:
+                    stack.append(sub_item)
+                elif sub_item.size >= max_size // 4:
+                    self.chunk_indices[id(sub_item)] = len(chunks)
+                    chunks.append(sub_item)
+        if len(chunks) < 2 or 'fork' not in multiprocessing.get_all_start_methods():
+            self.chunk_indices.clear()
+            return
+        render_state.update(chunks=chunks, callables=callables, tabstops=context.tabstops,
+                            fold=context.fold, use_color=use_color)
+        try:
+            self.pool = multiprocessing.get_context('fork').Pool(jobs)
+        finally:
+            render_state.clear()
+
+    def submit(self, item, context):
+        index = self.chunk_indices.get(id(item))
+        if index is None:
+            return None
+        return self.pool.apply_async(render_chunk, (index, context.shift, context.depth, list(context.lambda_args.counts)))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+
+
+def print_list(out, the_list: List, callables, context: Context):
+    walk(print_list_walker(out, the_list, callables, context))
+
+
+def mark_last(items):
+    items = iter(items)
+    for prev in items:
+        break
+    else:
+        return
+    for item in items:
+        yield prev, False
+        prev = item
+    yield prev, True
 
+
+def mark_last_in_list(items):
+    return zip(items, itertools.chain(itertools.repeat(False, len(items) - 1), (True,)))
+
+
+def print_list_walker(out, the_list, callables, context, marked_items=None):
+    """
+    Prints the_list, or the (item, is_last) pairs streamed by marked_items in
+    place of the contents of the_list.
+    """
+    if marked_items is None:
+        marked_items = mark_last_in_list(the_list.list)
     oper = get_oper(the_list)
-    is_long_oper = get_is_long_oper(the_list)
+    if context.layout is not None:
+        # the top level forms are printed by the walker at depth 2
+        is_long_oper = context.layout.breaks(the_list, out.column, context.trailing, context.depth - 1)
+    else:
+        is_long_oper = get_is_long_oper(the_list)
     is_block_oper = oper is not None and (oper in ('block'))
 
     if is_long_oper:
@@ -202,28 +708,18 @@ def print_list(out, the_list: List, callables, context: Context):
     if oper and oper in callables:
         child_list = callables[oper].children_names
 
-    for pos, item in enumerate(the_list.list):
-        is_last = (pos == (len(the_list.list) - 1))
+    for pos, (item, is_last) in enumerate(marked_items):
         is_first = (pos == 0)
 
         if not is_first and is_long_oper:
-            out.write('\n')
-            print_shift(context.shift)
+            out.newline(context.shift, context.tabstops)
 
         if pos > 0:
-            param_name = child_list.get(pos - 1, None)
-            if param_name == 'Input':
-                param_name = '⇐'
-            elif param_name == 'Lambda':
-                param_name = 'λ'
+            param_name = get_param_name(child_list, pos)
             if param_name:
-                with Color(COLOR_COMMENT):
-                    out.write('⦗')
-                    out.write(param_name)
-                    out.write('⦘')
-                if not is_first and is_long_oper and isinstance(item, List) and has_long_or_block_oper_inside(item):
-                    out.write('\n')
-                    print_shift(context.shift)
+                out.write_colored(COLOR_COMMENT, '⦗' + param_name + '⦘')
+                if not is_first and is_long_oper and context.layout is None and has_long_or_block_oper_inside(item):
+                    out.newline(context.shift, context.tabstops)
 
         if isinstance(item, List):
             is_lambda_args = (oper == 'lambda') and (pos == 1)
@@ -232,53 +728,51 @@ def print_list(out, the_list: List, callables, context: Context):
                 get_oper_color(sub_oper) if not is_lambda_args else COLOR_ARG
 
             arg_shift = context.shift
-            with Color(sub_oper_color):
-                if item.is_quote:
-                    out.write('\'')
-                out.write('(')
-            if is_block_oper:
-                arg_shift += 1
-                out.write('\n')
-                print_shift(arg_shift)
-
-            sub_ctx = Context(parent=context, shift=arg_shift, is_lambda_args=is_lambda_args)
-            print_list(out, item, callables, sub_ctx)
-            if is_lambda_args:
-                context.lambda_args.update(sub_ctx.lambda_args)
-            with Color(sub_oper_color):
-                out.write(')')
+            out.write_colored(sub_oper_color, '\'(' if item.is_quote else '(')
+            if context.fold is not None and not is_lambda_args and context.fold.is_folded(item, context.depth):
+                print_folded(out, item, context)
+            else:
+                if is_block_oper:
+                    arg_shift += 1
+                    out.newline(arg_shift, context.tabstops)
+
+                sub_ctx = Context(parent=context, shift=arg_shift, is_lambda_args=is_lambda_args)
+                if is_last and not is_long_oper:
+                    sub_ctx.trailing = context.trailing + 1
+                rendered = None
+                if context.parallel is not None and not is_lambda_args:
+                    rendered = context.parallel.submit(item, sub_ctx)
+                if rendered is not None:
+                    out.write_deferred(rendered)
+                else:
+                    yield print_list_walker(out, item, callables, sub_ctx)
+                if is_lambda_args:
+                    context.bind_args(sub_ctx.declared_args)
+            out.write_colored(sub_oper_color, ')')
             if sub_oper in ('return', 'let', 'declare'):
-                out.write('\n')
                 if is_last:
-                    print_shift(context.shift-1)
+                    out.newline(context.shift - 1, context.tabstops)
                 else:
-                    print_shift(context.shift)
+                    out.newline(context.shift, context.tabstops)
             elif not is_last:
                 out.write(' ')
         elif isinstance(item, Element):
             if item.is_quote:
-                with Color(COLOR_LITERAL):
-                    out.write('\'')
+                out.write_colored(COLOR_LITERAL, '\'')
             if item.is_quoted_str:
-                with Color(COLOR_STRING_LITERAL):
-                    out.write('"')
-                    out.write(item.value.encode('unicode_escape').decode('utf-8'))
-                    out.write('"')
+                out.write_colored(COLOR_STRING_LITERAL, out.escape_string(item.value))
             else:
                 color = get_oper_color(oper) if (oper and pos == 0) else COLOR_LITERAL
-                with Color(color):
-                    out.write(str(item.value))
+                out.write_colored(color, str(item.value))
             if not is_last:
                 out.write(' ')
         elif isinstance(item, Reference):
             if context.is_lambda_args:
                 color = COLOR_ARG
-                context.lambda_args.add(item.alias)
+                context.declared_args.append(item.alias)
             else:
                 color = COLOR_ARG if (item.alias in context.lambda_args) else COLOR_REF
-            with Color(color):
-                out.write('$')
-                out.write(str(item.alias))
+            out.write_colored(color, '$' + str(item.alias))
 
             if not is_last:
                 out.write(' ')
@@ -287,81 +781,120 @@ def print_list(out, the_list: List, callables, context: Context):
 
     if is_long_oper:
         context.shift -= 1
-        out.write('\n')
-        print_shift(context.shift)
+        out.newline(context.shift, context.tabstops)
+    if context.bound_args:
+        context.lambda_args.unbind(context.bound_args)
 
 class Macro:
+    __slots__ = ('definition', 'is_leaf', 'expansion')
+
     def __init__(self, definition, is_leaf):
         self.definition = definition
         self.is_leaf = is_leaf
+        self.expansion = None
 
 def collect_refs(the_list):
     table = {}
     ref_counts = {}
-    tail = None
-    is_leaf = True
-    scanning_ref_id = None
-
-    if len(the_list.list) > 2:
-        oper = None
-        item = the_list.list[0]
-        if isinstance(item, Element) and not item.is_quote and not item.is_quoted_str and isinstance(item.value, str):
-            oper = item.value
-        ref = the_list.list[1]
-        if oper =='let' and isinstance(ref, Reference):
-            scanning_ref_id = ref.alias
-            tail = the_list.list[2:]
+    annotate(the_list)
 
-    if tail is None:
-        tail = the_list.list
-
-    for item in tail:
-        if isinstance(item, List):
-            sub_table, sub_counts, sub_is_leaf = collect_refs(item)
-            if not sub_is_leaf:
-                is_leaf = False
-            table.update(sub_table)
-            for ref, cnt in sub_counts.items():
-                ref_counts[ref] = ref_counts.get(ref, 0) + cnt
-        elif isinstance(item, Reference):
-            is_leaf = False
-            ref = item.alias
-            ref_counts[ref] = ref_counts.get(ref, 0) + 1
+    stack = [the_list]
+    while stack:
+        item = stack.pop()
+        tail = item.list
+        if len(tail) > 2 and get_oper(item) == 'let' and isinstance(tail[1], Reference):
+            tail = tail[2:]
+            table[item.list[1].alias] = Macro(tail, not (item.flags & HAS_REFS))
 
-    if scanning_ref_id is not None:
-        table[scanning_ref_id] = Macro(tail, is_leaf)
+        for sub_item in reversed(tail):
+            if isinstance(sub_item, List):
+                stack.append(sub_item)
+            elif isinstance(sub_item, Reference):
+                ref = sub_item.alias
+                ref_counts[ref] = ref_counts.get(ref, 0) + 1
 
-    return table, ref_counts, is_leaf
+    return table, ref_counts, not (the_list.flags & HAS_REFS)
 
 def simple_enough_macro(the_list):
-    simple = True
     for item in the_list:
-        if isinstance(item, List):
-            oper = get_oper(item)
-            if oper == 'lambda' and len(item.list) > 1 and isinstance(item.list[1], List):
-                lambda_args = set()
-                for sub_item in item.list[1].list:
-                    if isinstance(sub_item, Reference):
-                        lambda_args.add(sub_item.alias)
-                is_simple_lambda = False
-                for def_item in item.list[2:]:
-                    if not isinstance(def_item, Reference):
-                        break
-                    if def_item.alias not in lambda_args:
-                        break
-                else:
-                    is_simple_lambda = True
-                simple = simple and is_simple_lambda
-                continue
-            if oper is None:
-                if not simple_enough_macro(item.list):
-                    simple = False
-                    break
-                continue
-            simple = simple and (oper in SIMPLE_OPERATORS)
-    return simple
+        if isinstance(item, List) and not (annotate(item).flags & IS_SIMPLE):
+            return False
+    return True
+
+class InlineBudget:
+    """
+    Cost model for inlining a macro: doing so grows the output by
+    (uses - 1) * (size - 1) nodes. Macros larger than max_size nodes are not
+    inlined at more than one place, and all inlining together may not grow
+    the output by more than max_growth nodes.
+    """
+    def __init__(self, max_size=None, max_growth=None):
+        self.max_size = max_size
+        self.remaining = max_growth
+
+    def allow(self, size, uses):
+        if self.max_size is not None and size > self.max_size:
+            return False
+        growth = (uses - 1) * (size - 1)
+        if self.remaining is not None:
+            if growth > self.remaining:
+                return False
+            self.remaining -= growth
+        return True
+
+
+def expansion_size(replaced):
+    size = 0
+    for item in replaced:
+        size += annotate(item).size if isinstance(item, List) else 1
+    return size
+
+def expand_macro_walker(ref_id, table, ref_counts, budget=None):
+    """
+    Expands the definition of ref_id once. The result is cached in the Macro
+    and shared by all the places the reference gets inlined into.
+    """
+    should_replace = False
+    if (ref_counts.get(ref_id, 0) == 1 or table[ref_id].is_leaf):
+        should_replace = True
+
+    # this will copy referenced list before mutating
+    replaced, sub_did_replace = yield replace_refs_walker(table[ref_id].definition, table, ref_counts, budget=budget)
+
+    # if not should_replace:
+    #     oper = get_oper_from_raw_list(the_list)
+    #     if oper == 'DqPhyStage' and pos == 2:
+    #         should_replace = True
+
+    if not should_replace and ref_counts.get(ref_id) <= 3:
+        # Maybe we still can decide to replace if the content is simple enough
+        should_replace = simple_enough_macro(replaced)
 
-def replace_refs(the_list, table, ref_counts, current_let_ref_id=None):
+    if should_replace and budget is not None and ref_counts.get(ref_id, 0) > 1:
+        should_replace = budget.allow(expansion_size(replaced), ref_counts[ref_id])
+
+    return replaced, sub_did_replace, should_replace
+
+def let_is_dropped_walker(ref_id, table, ref_counts, budget=None):
+    """
+    Tells whether the let of ref_id can be removed right away because it is
+    guaranteed to be replaced. With a budget the inlining decision for a let is
+    taken where the let is, so that it does not depend on the order uses are met.
+    """
+    count = ref_counts.get(ref_id, 0)
+    if budget is None:
+        return count == 1 or table[ref_id].is_leaf
+    if count == 0 and not table[ref_id].is_leaf:
+        return False
+    macro = table[ref_id]
+    if macro.expansion is None:
+        macro.expansion = yield expand_macro_walker(ref_id, table, ref_counts, budget)
+    return (count == 1 or table[ref_id].is_leaf) and macro.expansion[2]
+
+def replace_refs(the_list, table, ref_counts, current_let_ref_id=None, budget=None):
+    return walk(replace_refs_walker(the_list, table, ref_counts, current_let_ref_id, budget))
+
+def replace_refs_walker(the_list, table, ref_counts, current_let_ref_id=None, budget=None):
     rebuilt = []
     did_replace = set()
 
@@ -375,13 +908,13 @@ def replace_refs(the_list, table, ref_counts, current_let_ref_id=None):
                 if isinstance(sub_list[0], Element) and not sub_list[0].is_quote and not sub_list[0].is_quoted_str and sub_list[0].value == 'let' and isinstance(sub_list[1], Reference):
                     ref_id = sub_list[1].alias
                     # Remove let definitions that are guaranteed to be replaced
-                    if not (ref_counts.get(ref_id, 0) == 1 or table[ref_id].is_leaf):
+                    if not (yield let_is_dropped_walker(ref_id, table, ref_counts, budget)):
                         l = List(item.is_quote)
-                        l.list, sub_did_replace = replace_refs(sub_list, table, ref_counts, ref_id)
+                        l.list, sub_did_replace = yield replace_refs_walker(sub_list, table, ref_counts, ref_id, budget)
                         lets.append((ref_id, l, sub_did_replace))
                     continue
             l = List(item.is_quote)
-            l.list, sub_did_replace = replace_refs(sub_list, table, ref_counts, None)
+            l.list, sub_did_replace = yield replace_refs_walker(sub_list, table, ref_counts, None, budget)
             did_replace |= sub_did_replace
             rebuilt.append(l)
             continue
@@ -393,21 +926,10 @@ def replace_refs(the_list, table, ref_counts, current_let_ref_id=None):
                 continue
 
             if ref_id in table:
-                should_replace = False
-                if (ref_counts.get(ref_id, 0) == 1 or table[ref_id].is_leaf):
-                    should_replace = True
-
-                # this will copy referenced list before mutating
-                replaced, sub_did_replace = replace_refs(table[ref_id].definition, table, ref_counts)
-
-                # if not should_replace:
-                #     oper = get_oper_from_raw_list(the_list)
-                #     if oper == 'DqPhyStage' and pos == 2:
-                #         should_replace = True
-
-                if not should_replace and ref_counts.get(ref_id) <= 3:
-                    # Maybe we still can decide to replace if the content is simple enough
-                    should_replace = simple_enough_macro(replaced)
+                macro = table[ref_id]
+                if macro.expansion is None:
+                    macro.expansion = yield expand_macro_walker(ref_id, table, ref_counts, budget)
+                replaced, sub_did_replace, should_replace = macro.expansion
 
                 if should_replace:
                     rebuilt += replaced
@@ -430,13 +952,19 @@ def replace_refs(the_list, table, ref_counts, current_let_ref_id=None):
     return filtered_lets + rebuilt, did_replace
 
 
-def simplify_blocks(the_list):
+def simplify_blocks(the_list, simplified=None):
     """
     Replace (block '( (return a b c) ) with a b c.
-    Returns a copy of the program, does not mutate anything in-place
+    Returns a copy of the program, does not mutate anything in-place.
+    Lists shared after replace_refs() are simplified once and stay shared.
     """
-    result = []
+    if simplified is None:
+        simplified = {}
+    return walk(simplify_blocks_walker(the_list, simplified))
+
 
+def simplify_blocks_walker(the_list, simplified):
+    result = []
     for item in the_list:
         if isinstance(item, List):
             if get_oper(item) == 'block' and not item.is_quote and len(item.list) == 2:
@@ -444,10 +972,13 @@ def simplify_blocks(the_list):
                 if isinstance(block_content, List) and len(block_content.list) == 1:
                     maybe_return = block_content.list[0]
                     if get_oper(maybe_return) == 'return':
-                        result += simplify_blocks(maybe_return.list[1:])
+                        result += yield simplify_blocks_walker(maybe_return.list[1:], simplified)
                         continue
-            new_list = List(item.is_quote)
-            new_list.list = simplify_blocks(item.list)
+            new_list = simplified.get(id(item))
+            if new_list is None:
+                new_list = List(item.is_quote)
+                new_list.list = yield simplify_blocks_walker(item.list, simplified)
+                simplified[id(item)] = new_list
             result.append(new_list)
         else:
             result.append(item)
@@ -455,88 +986,381 @@ def simplify_blocks(the_list):
     return result
 
 
-def read_string(line, pos):
-    esc = False
-    res = ''
-    while pos < len(line):
-        if esc:
-            res += line[pos]
-            pos += 1
-            esc = False
-            continue
-        if line[pos] == '\\':
-            esc = True
-            pos += 1
-            continue
-        if line[pos] == '"':
-            return res, pos + 1
-        res += line[pos]
-        pos += 1
-    raise Exception("unterminated quoted string")
+class LazyList(List):
+    """
+    A list of the program as expanded by LazyExpansion. Its items are made on
+    first access: until then the list slot is unset and __getattr__ fills it.
+    """
+    __slots__ = ('source', 'expansion')
+
+    def __init__(self, source, expansion):
+        self.is_quote = source.is_quote
+        self.size = 0
+        self.depth = 0
+        self.flags = 0
+        self.source = source
+        self.expansion = expansion
 
+    def __getattr__(self, name):
+        if name != 'list':
+            raise AttributeError(name)
+        self.list = self.expansion.expand(self.source)
+        return self.list
 
-def read_num(line, pos):
-    start = pos
-    while pos < len(line):
-        if not line[pos].isdigit():
-            return int(line[start:pos]), pos
-        pos += 1
-    return int(line[start:]), pos
 
+class LazyExpansion:
+    """
+    Same as replace_refs() followed by simplify_blocks(), but a list at a time,
+    when the renderer gets to it, so the parts that are never printed are never
+    expanded. Whether a ref is inlined is decided once, when first needed, the
+    same way expand_macro_walker() does. A let is dropped if its ref is
+    inlined, which replace_refs() finds out from where the ref was replaced.
+    With share, a list inlined at several places is expanded once and the
+    expansion shared, as replace_refs() does.
+    """
+    def __init__(self, table, ref_counts, share=True):
+        self.table = table
+        self.ref_counts = ref_counts
+        self.decisions = {}
+        self.definitions = {}
+        self.lazy_lists = {} if share else None
+
+    def wrap(self, the_list):
+        if self.lazy_lists is None:
+            return LazyList(the_list, self)
+        lazy_list = self.lazy_lists.get(id(the_list))
+        if lazy_list is None:
+            lazy_list = self.lazy_lists[id(the_list)] = LazyList(the_list, self)
+        return lazy_list
+
+    def expand(self, the_list):
+        return self.simplify(walk(self.replace_walker(the_list.list, get_let_ref_id(the_list))))
+
+    def simplify(self, items):
+        """
+        One level of simplify_blocks() over replaced items
+        """
+        result = []
+        for item in items:
+            if isinstance(item, List):
+                if get_oper(item) == 'block' and not item.is_quote:
+                    block = self.wrap(item).list
+                    if len(block) == 2 and isinstance(block[1], List):
+                        block_content = block[1].list
+                        if len(block_content) == 1 and isinstance(block_content[0], List) and \
+                                get_oper(block_content[0]) == 'return':
+                            result += block_content[0].list[1:]
+                            continue
+                result.append(self.wrap(item))
+            else:
+                result.append(item)
+        return result
+
+    def replace_walker(self, items, current_let_ref_id=None):
+        """
+        One level of replace_refs_walker(): the lists in the result are the
+        parsed ones, not replaced yet
+        """
+        rebuilt = []
+        lets = []
+        for item in items:
+            if isinstance(item, List):
+                ref_id = get_let_ref_id(item)
+                if ref_id is None:
+                    rebuilt.append(item)
+                elif (yield self.let_is_kept_walker(ref_id)):
+                    lets.append(item)
+            elif isinstance(item, Reference) and item.alias != current_let_ref_id and item.alias in self.table:
+                # most refs are met after their decision is made
+                should_replace = self.decisions.get(item.alias)
+                if should_replace is None:
+                    should_replace = yield self.should_replace_walker(item.alias)
+                if should_replace:
+                    definition = self.definitions.get(item.alias)
+                    if definition is None:
+                        definition = yield self.definition_walker(item.alias)
+                    rebuilt += definition
+                else:
+                    rebuilt.append(item)
+            else:
+                rebuilt.append(item)
+        return lets + rebuilt
+
+    def definition_walker(self, ref_id):
+        items = self.definitions.get(ref_id)
+        if items is None:
+            items = yield self.replace_walker(self.table[ref_id].definition)
+            self.definitions[ref_id] = items
+        return items
+
+    def let_is_kept_walker(self, ref_id):
+        if self.table[ref_id].is_leaf:
+            return False
+        return self.ref_counts.get(ref_id, 0) == 0 or not (yield self.should_replace_walker(ref_id))
+
+    def should_replace_walker(self, ref_id):
+        should_replace = self.decisions.get(ref_id)
+        if should_replace is not None:
+            return should_replace
+        count = self.ref_counts.get(ref_id, 0)
+        should_replace = count == 1 or self.table[ref_id].is_leaf
+        if not should_replace and count <= 3:
+            # simple_enough_macro() of the replaced definition
+            should_replace = True
+            for item in (yield self.definition_walker(ref_id)):
+                if isinstance(item, List) and not (yield self.is_simple_walker(item)):
+                    should_replace = False
+                    break
+        self.decisions[ref_id] = should_replace
+        return should_replace
+
+    def is_simple_walker(self, the_list):
+        """
+        The IS_SIMPLE flag annotate() would give the_list after replace_refs()
+        """
+        items = yield self.replace_walker(the_list.list, get_let_ref_id(the_list))
+        oper = get_oper_from_raw_list(items)
+        if oper == 'lambda' and len(items) > 1 and isinstance(items[1], List):
+            arg_items = yield self.replace_walker(items[1].list, get_let_ref_id(items[1]))
+            lambda_args = set(item.alias for item in arg_items if isinstance(item, Reference))
+            return all(isinstance(item, Reference) and item.alias in lambda_args for item in items[2:])
+        elif oper is None:
+            for item in items:
+                if isinstance(item, List) and not (yield self.is_simple_walker(item)):
+                    return False
+            return True
+        return oper in SIMPLE_OPERATORS
 
-def read_keyword(line, pos):
-    start = pos
-    while pos < len(line):
-        if line[pos] == ')' or line[pos].isspace():
-            return line[start:pos], pos
-        pos += 1
-    return line[start:]
 
+def share_subtrees(program, min_size):
+    """
+    Hash-conses an expanded program: lists are keyed bottom-up by their quote
+    and the identities of their already shared items, so structurally equal
+    lists become one instance. Closed lists (using no reference bound outside
+    of them) of at least min_size nodes that would still be printed more than
+    once are then moved to new lets at the start of the top level block.
+    Returns the new program and the number of lets added.
+    """
+    canonical = {}
+    canonical_of = {}
+    free_refs = {}
+    order = []
+    max_alias = 0
+    no_refs = frozenset()
+
+    stack = [(program, False)]
+    while stack:
+        item, children_done = stack.pop()
+        if id(item) in canonical_of:
+            continue
+        if not children_done:
+            stack.append((item, True))
+            for sub_item in item.list:
+                if isinstance(sub_item, List) and id(sub_item) not in canonical_of:
+                    stack.append((sub_item, False))
+            continue
 
-def parse(f):
+        items = [canonical_of[id(sub_item)] if isinstance(sub_item, List) else sub_item for sub_item in item.list]
+        # parse_buffer() creates one atom per distinct token, so atoms compare by identity too
+        key = (item.is_quote, tuple(map(id, items)))
+        node = canonical.get(key)
+        if node is None:
+            if all(a is b for a, b in zip(items, item.list)):
+                node = item
+            else:
+                node = List(item.is_quote)
+                node.list = items
+            canonical[key] = node
+            order.append(node)
+
+            free = no_refs
+            for sub_item in items:
+                if isinstance(sub_item, List):
+                    sub_free = free_refs[id(sub_item)]
+                elif isinstance(sub_item, Reference):
+                    sub_free = frozenset((sub_item.alias,))
+                    if sub_item.alias > max_alias:
+                        max_alias = sub_item.alias
+                else:
+                    continue
+                if sub_free:
+                    free = free | sub_free if free else sub_free
+            if free and get_oper(node) == 'lambda' and len(items) > 1 and isinstance(items[1], List):
+                free = free - {sub_item.alias for sub_item in items[1].list if isinstance(sub_item, Reference)}
+            free_refs[id(node)] = free
+        canonical_of[id(item)] = node
+
+    top = annotate(canonical_of[id(program)])
+    if len(top.list) != 1 or not isinstance(top.list[0], List):
+        return top, 0
+
+    # Count how many times each list gets printed, parents before children.
+    # Statements and lambda arguments must stay in place.
+    uses = {id(top): 1}
+    pinned = {id(top.list[0])}
+    hoisted = set()
+    for node in reversed(order):
+        count = uses.get(id(node), 0)
+        oper = get_oper(node)
+        # a let costs its name, the let keyword and its list on top of the uses
+        if count > 1 and node.size >= min_size and count * node.size > count + node.size + 3 \
+                and not free_refs[id(node)] and id(node) not in pinned and oper not in ('let', 'return', 'declare'):
+            hoisted.add(id(node))
+            count = 1
+        if node is top.list[0] or oper == 'block':
+            pinned.update(id(sub_item) for sub_item in node.list if isinstance(sub_item, List))
+        elif oper == 'lambda' and len(node.list) > 1:
+            pinned.add(id(node.list[1]))
+        for sub_item in node.list:
+            if isinstance(sub_item, List):
+                uses[id(sub_item)] = uses.get(id(sub_item), 0) + count
+    if not hoisted:
+        return top, 0
+
+    rebuilt = {}
+    aliases = {}
+    lets = []
+    let_oper = Element(False, 'let')
+    for node in order:
+        items = [aliases.get(id(sub_item)) or rebuilt[id(sub_item)] if isinstance(sub_item, List) else sub_item
+                 for sub_item in node.list]
+        if all(a is b for a, b in zip(items, node.list)):
+            new_node = node
+        else:
+            new_node = List(node.is_quote)
+            new_node.list = items
+        rebuilt[id(node)] = new_node
+        if id(node) in hoisted:
+            max_alias += 1
+            aliases[id(node)] = Reference(max_alias)
+            let = List(False)
+            let.list = [let_oper, aliases[id(node)], new_node]
+            lets.append(let)
+
+    body = rebuilt[id(top.list[0])]
+    new_body = List(body.is_quote)
+    new_body.list = lets + body.list
+    new_top = List(top.is_quote)
+    new_top.list = [new_body]
+    return new_top, len(lets)
+
+
+TOKEN_RE = re.compile(r'''
+    (?P<space>\s+)
+    | (?P<quote>')
+    | (?P<open>\()
+    | (?P<close>\))
+    | "(?P<string>[^"\\]*(?:\\.[^"\\]*)*)"
+    | (?P<num>\d+)
+    | \$(?P<ref>\d*)
+    | (?P<keyword>[^\s'()"$\d][^\s)]*)
+    | (?P<unterminated>")
+''', re.VERBOSE | re.DOTALL)
+
+# the same tokens in UTF-8 bytes, for buffers parsed without decoding them
+TOKEN_BYTES_RE = re.compile(TOKEN_RE.pattern.encode('utf-8'), re.VERBOSE | re.DOTALL)
+
+ESCAPE_RE = re.compile(r'\\(.)', re.DOTALL)
+
+
+def unescape(tok):
+    # A backslash just keeps the next character as is
+    if '\0' in tok:
+        return ESCAPE_RE.sub(r'\1', tok)
+    return tok.replace('\\\\', '\0').replace('\\', '').replace('\0', '\\')
+
+
+def parse_buffer(text):
+    """
+    Parses a str, or UTF-8 in a bytes-like buffer such as an mmap, which is
+    tokenized in place: only the atoms are decoded
+    """
     curr_stack = [List(False)]
     is_quote = False
+    atoms = ({}, {})
+    is_bytes = not isinstance(text, str)
 
-    def push(item):
-        curr_stack[-1].list.append(item)
-
-    for line in f:
-        line = line.strip()
-        if not line:
+    for match in (TOKEN_BYTES_RE if is_bytes else TOKEN_RE).finditer(text):
+        kind = match.lastgroup
+        if kind == 'space':
+            is_quote = False
+            continue
+        if kind == 'quote':
+            is_quote = True
             continue
-        pos = 0
-        while pos < len(line):
-            if line[pos] == '\'':
-                is_quote = True
-                pos += 1
-                continue
 
-            if line[pos] == '(':
-                l = List(is_quote)
-                push(l)
-                curr_stack.append(l)
-                pos += 1
-            elif line[pos] == '"':
-                tok, pos = read_string(line, pos + 1)
-                push(Element(is_quote, tok, is_quoted_str=True))
-            elif line[pos].isdigit():
-                tok, pos = read_num(line, pos)
-                push(Element(is_quote, tok))
-            elif line[pos] == ')':
-                curr_stack.pop()
-                pos += 1
-            elif line[pos] == '$':
-                tok, pos = read_num(line, pos+1)
-                push(Reference(tok))
-            elif line[pos].isspace():
-                pos += 1
-            else:
-                tok, pos = read_keyword(line, pos)
-                push(Element(is_quote, tok))
-            is_quote = False
+        if kind == 'open':
+            l = List(is_quote)
+            curr_stack[-1].list.append(l)
+            curr_stack.append(l)
+        elif kind == 'close':
+            curr_stack.pop()
+        elif kind == 'unterminated':
+            raise Exception("unterminated quoted string")
+        else:
+            tok = match.group()
+            atom = atoms[is_quote].get(tok)
+            if atom is None:
+                if kind == 'string':
+                    value = match.group('string')
+                    if is_bytes:
+                        value = value.decode('utf-8')
+                    if '\\' in value:
+                        value = unescape(value)
+                    atom = Element(is_quote, value, is_quoted_str=True)
+                elif kind == 'num':
+                    atom = Element(is_quote, int(tok))
+                elif kind == 'ref':
+                    atom = Reference(int(match.group('ref')))
+                else:
+                    atom = Element(is_quote, sys.intern(tok.decode('utf-8') if is_bytes else tok))
+                atoms[is_quote][tok] = atom
+            curr_stack[-1].list.append(atom)
+        is_quote = False
 
     return curr_stack[0]
 
+
+def parse(f):
+    return parse_buffer(f.read())
+
+
+READ_CHUNK_SIZE = 1 << 20
+
+
+def open_compressed(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.xz'):
+        return lzma.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise Exception("reading %s needs the zstandard module" % path)
+        return zstandard.open(path, 'rb')
+    return None
+
+
+def read_input(path):
+    """
+    The contents of a plan file for parse_buffer(): regular files are mapped
+    into memory, .gz, .xz and .zst files are decompressed chunk by chunk
+    """
+    compressed = open_compressed(path)
+    if compressed is not None:
+        data = bytearray()
+        with compressed:
+            while True:
+                chunk = compressed.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    return data
+                data += chunk
+    with open(path, 'rb') as inf:
+        st = os.fstat(inf.fileno())
+        # empty files can't be mapped, pipes and devices can't be at all
+        if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+            return inf.read()
+        return mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+
 class NodeDescr:
     def __init__(self, name, base, match_callable, children_names):
         self.name = name
@@ -609,25 +1433,1074 @@ def build_callable_index(node_descriptions):
 
     return result
 
-if __name__ == '__main__':
-    argparser = argparse.ArgumentParser()
-    argparser.add_argument('-n', '--nodes', default=[], action='append')
-    argparser.add_argument('-r', '--repo', default=None)
-    argparser.add_argument('-t', '--tabstops', action='store_true', default=False)
-    args = argparser.parse_args()
+def get_let_ref_id(item):
+    if isinstance(item, List) and len(item.list) > 2 and get_oper(item) == 'let' and isinstance(item.list[1], Reference):
+        return item.list[1].alias
+    return None
+
+
+def can_stream(program):
+    # Streaming needs a single (let ... return) wrapper whose items all stay
+    # lists, so that it prints exactly like the whole program would
+    if len(program.list) != 1 or not isinstance(program.list[0], List):
+        return False
+    for item in program.list[0].list:
+        if not isinstance(item, List) or get_oper(item) == 'block':
+            return False
+    return True
+
+
+def stream_top_level_forms(out, wrapper, table, ref_counts, budget=None):
+    """
+    Expands and simplifies the forms of the top level wrapper one at a time and
+    yields them as (form, is_last) pairs for print_list_walker(). Same as
+    replace_refs() it puts the kept lets before all the other forms.
+    Without a budget the forms are expanded lazily, as they are printed.
+    """
+    if budget is None:
+        # nothing is shared between forms, so each is released once printed
+        expansion = LazyExpansion(table, ref_counts, share=False)
+        lets = [item for item in wrapper.list if get_let_ref_id(item) is not None]
+        forms = itertools.chain(
+            (item for item in lets if walk(expansion.let_is_kept_walker(get_let_ref_id(item)))),
+            (item for item in wrapper.list if get_let_ref_id(item) is None))
+
+        def lazy_forms():
+            for form in forms:
+                yield from expansion.simplify([form])
+                out.flush()
+
+        return mark_last(lazy_forms())
+
+    def kept_lets():
+        for item in wrapper.list:
+            ref_id = get_let_ref_id(item)
+            if ref_id is None:
+                continue
+            if walk(let_is_dropped_walker(ref_id, table, ref_counts, budget)):
+                continue
+            # Lets that are inlined at their uses are dropped
+            if ref_counts.get(ref_id, 0) > 0:
+                macro = table[ref_id]
+                if macro.expansion is None:
+                    macro.expansion = walk(expand_macro_walker(ref_id, table, ref_counts, budget))
+                if macro.expansion[2]:
+                    continue
+            l = List(item.is_quote)
+            l.list, _ = replace_refs(item.list, table, ref_counts, ref_id, budget)
+            yield l
+
+    def other_forms():
+        for item in wrapper.list:
+            if get_let_ref_id(item) is None:
+                yield from replace_refs([item], table, ref_counts, budget=budget)[0]
+
+    def simplified_forms():
+        for form in itertools.chain(kept_lets(), other_forms()):
+            yield from simplify_blocks([form])
+            out.flush()
+
+    return mark_last(simplified_forms())
+
+
+class Stats:
+    """
+    Collects what --stats reports: wall time and peak traced memory of every
+    stage, and the sizes of the program before and after expansion.
+    """
+    def __init__(self):
+        self.stages = []
+        self.facts = []
+        self.top_refs = []
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages.append((name, elapsed, tracemalloc.get_traced_memory()[1]))
+
+    def add(self, name, value):
+        self.facts.append((name, value))
+
+    def collect_program(self, program, table, ref_counts):
+        lists, atoms, quotes = count_nodes(program)
+        # the root list holding the top level forms has no parens in the text
+        self.add('tokens', 2 * (lists - 1) + atoms + quotes)
+        self.add('input nodes', lists + atoms)
+        self.add('let bindings', len(table))
+        self.input_nodes = lists + atoms
+
+    def collect_expansion(self, replaced_program, simplified_program, table, ref_counts, did_replace):
+        kept = count_lets(replaced_program)
+        inlined = len(did_replace & table.keys())
+        self.add('lets inlined', inlined)
+        self.add('lets kept', kept)
+        self.add('lets dropped unused', len(table) - inlined - kept)
+        output_nodes = annotate(simplified_program).size
+        self.add('output nodes', output_nodes)
+        if self.input_nodes:
+            self.add('expansion ratio', '%.2f' % (output_nodes / self.input_nodes))
+
+        for ref_id, macro in table.items():
+            if macro.expansion is None:
+                continue
+            replaced, _, should_replace = macro.expansion
+            size = 0
+            for item in replaced:
+                size += annotate(item).size if isinstance(item, List) else 1
+            uses = ref_counts.get(ref_id, 0)
+            output_size = size * uses if ref_id in did_replace else size
+            self.top_refs.append((output_size, ref_id, size, uses, ref_id in did_replace))
+        self.top_refs.sort(reverse=True)
+
+    def report(self, f, top=10):
+        print('stage                    time, s    peak memory, MB', file=f)
+        for name, elapsed, peak in self.stages:
+            print('%-20s %12.4f %16.2f' % (name, elapsed, peak / 1e6), file=f)
+        for name, value in self.facts:
+            print('%-20s %12s' % (name, value), file=f)
+        if self.top_refs:
+            print('most expensive refs:', file=f)
+            print('    ref        output nodes  expanded size  uses  inlined', file=f)
+            for output_size, ref_id, size, uses, inlined in self.top_refs[:top]:
+                print('    $%-8d %14d %14d %5d  %s' % (ref_id, output_size, size, uses, 'yes' if inlined else 'no'), file=f)
+
+
+def count_nodes(the_list):
+    lists = 0
+    atoms = 0
+    quotes = 0
+    stack = [the_list]
+    while stack:
+        item = stack.pop()
+        lists += 1
+        if item.is_quote:
+            quotes += 1
+        for sub_item in item.list:
+            if isinstance(sub_item, List):
+                stack.append(sub_item)
+            else:
+                atoms += 1
+                if isinstance(sub_item, Element) and sub_item.is_quote:
+                    quotes += 1
+    return lists, atoms, quotes
+
+
+def count_lets(the_list):
+    lets = 0
+    seen = set()
+    stack = [the_list]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        if get_let_ref_id(item) is not None:
+            lets += 1
+        for sub_item in item.list:
+            if isinstance(sub_item, List):
+                stack.append(sub_item)
+    return lets
+
+
+class JsonEmitter:
+    """
+    Writes expanded top level forms as JSON, piece by piece into out:
+    lists are {"type": "list", "quote", "oper", "items"}, atoms are
+    {"type": "atom", "quote", "value", "string"} and references are
+    {"type": "ref", "alias", "kind"} with kind "lambda_arg", "let" for the
+    name of a let, or "ref". Items of callables get the "param" name of their
+    child. With jsonl every form goes on its own line, otherwise all of them
+    make a single array.
+    """
+    def __init__(self, out, callables, jsonl=False):
+        self.out = out
+        self.callables = callables
+        self.jsonl = jsonl
+        self.lambda_args = LambdaArgs()
+        self.atoms = {}
+        self.forms = 0
+
+    def begin(self):
+        if not self.jsonl:
+            self.out.write('[')
+
+    def end(self):
+        self.out.write('\n' if self.jsonl else '\n]\n')
+        self.out.flush()
+
+    def emit_form(self, form):
+        if self.forms:
+            self.out.write('\n' if self.jsonl else ',\n')
+        elif not self.jsonl:
+            self.out.write('\n')
+        self.forms += 1
+        if isinstance(form, List):
+            walk(self.list_walker(form, None, False))
+        else:
+            self.write_atom(form, None, 'ref')
+
+    def write_atom(self, item, param, kind):
+        key = (id(item), kind)
+        text = self.atoms.get(key)
+        if text is None:
+            if isinstance(item, Reference):
+                text = '{"type":"ref","alias":%d,"kind":"%s"' % (item.alias, kind)
+            else:
+                text = '{"type":"atom","quote":%s,"value":%s,"string":%s' % (
+                    'true' if item.is_quote else 'false', json.dumps(item.value),
+                    'true' if item.is_quoted_str else 'false')
+            self.atoms[key] = text
+        self.out.write(text)
+        if param:
+            self.out.write(',"param":' + json.dumps(param))
+        self.out.write('}')
+
+    def list_walker(self, the_list, param, is_lambda_args):
+        out = self.out
+        items = the_list.list
+        oper = get_oper(the_list)
+        out.write('{"type":"list","quote":%s,"oper":%s' % ('true' if the_list.is_quote else 'false', json.dumps(oper)))
+        if param:
+            out.write(',"param":' + json.dumps(param))
+        out.write(',"items":[')
+
+        child_names = self.callables[oper].children_names if oper in self.callables else {}
+        let_ref_id = get_let_ref_id(the_list)
+        bound = []
+        if oper == 'lambda' and len(items) > 1 and isinstance(items[1], List):
+            bound = [item.alias for item in items[1].list if isinstance(item, Reference)]
+
+        for pos, item in enumerate(items):
+            if pos:
+                out.write(',')
+            item_param = child_names.get(pos - 1) if pos else None
+            if isinstance(item, List):
+                yield self.list_walker(item, item_param, bool(bound) and pos == 1)
+                if bound and pos == 1:
+                    # the arguments are in scope in the rest of the lambda
+                    self.lambda_args.bind(bound)
+            elif isinstance(item, Element):
+                self.write_atom(item, item_param, None)
+            elif is_lambda_args or item.alias in self.lambda_args:
+                self.write_atom(item, item_param, 'lambda_arg')
+            elif pos == 1 and let_ref_id is not None:
+                self.write_atom(item, item_param, 'let')
+            else:
+                self.write_atom(item, item_param, 'ref')
+
+        if bound:
+            self.lambda_args.unbind(bound)
+        out.write(']}')
+
+
+def top_level_forms(program):
+    if len(program.list) == 1 and isinstance(program.list[0], List) and get_oper(program.list[0]) is None:
+        return program.list[0].list
+    return program.list
+
+
+class Options:
+    def __init__(self, tabstops=False, stream=False, max_inline_size=None, max_inline_growth=None, cse_min_size=None,
+                 max_depth=None, fold_larger_than=None, only=None, snapshot=None, snapshot_expanded=False,
+                 format='text', render_jobs=None, width=None, summary=False):
+        self.tabstops = tabstops
+        self.stream = stream
+        self.max_inline_size = max_inline_size
+        self.max_inline_growth = max_inline_growth
+        self.cse_min_size = cse_min_size
+        self.max_depth = max_depth
+        self.fold_larger_than = fold_larger_than
+        self.only = only
+        self.snapshot = snapshot
+        self.snapshot_expanded = snapshot_expanded
+        self.format = format
+        self.render_jobs = render_jobs
+        self.width = width
+        self.summary = summary
+
+    @staticmethod
+    def from_args(args):
+        return Options(tabstops=args.tabstops, stream=args.stream,
+                       max_inline_size=args.max_inline_size, max_inline_growth=args.max_inline_growth,
+                       cse_min_size=args.cse, max_depth=args.max_depth, fold_larger_than=args.fold_larger_than,
+                       only=set(args.only.split(',')) if args.only else None,
+                       snapshot=args.snapshot, snapshot_expanded=args.snapshot_expanded, format=args.format,
+                       render_jobs=args.render_jobs, width=args.width, summary=args.summary)
+
+    def make_fold(self):
+        if self.max_depth is None and self.fold_larger_than is None and self.only is None:
+            return None
+        return Fold(self.max_depth, self.fold_larger_than, self.only)
+
+    def make_layout(self, callables):
+        if self.width is None:
+            return None
+        return Layout(self.width, callables)
+
+    def expansion_key(self):
+        # everything the expanded program depends on
+        return hashlib.sha1(repr((self.max_inline_size, self.max_inline_growth)).encode('utf-8')).digest()
+
+    def make_inline_budget(self, program):
+        if self.max_inline_size is None and self.max_inline_growth is None:
+            return None
+        max_growth = None
+        if self.max_inline_growth is not None:
+            max_growth = int(self.max_inline_growth * annotate(program).size)
+        return InlineBudget(self.max_inline_size, max_growth)
+
+
+def stats_stage(stats, name):
+    return stats.stage(name) if stats is not None else contextlib.nullcontext()
+
+
+def pretty_print(text, out, callables, options, stats=None):
+    snapshot = None
+    if options.snapshot is not None:
+        input_hash = hashlib.sha1(text.encode('utf-8') if isinstance(text, str) else text).digest()
+        snapshot_path = options.snapshot or os.path.join(get_cache_dir(), 'snapshot-%s.bin' % input_hash.hex())
+        with stats_stage(stats, 'load snapshot'):
+            snapshot = load_snapshot(snapshot_path, input_hash)
+        if stats is not None:
+            stats.add('snapshot', 'loaded' if snapshot is not None else 'written')
+
+    if snapshot is not None:
+        program, expanded_program, expansion_key = snapshot
+        if options.snapshot_expanded and expanded_program is not None and expansion_key == options.expansion_key():
+            print_expanded(out, expanded_program, callables, options, stats)
+            return
+    else:
+        with stats_stage(stats, 'parse'):
+            program = parse_buffer(text)
+        if options.snapshot is not None and not (options.snapshot_expanded and not options.stream):
+            save_snapshot(snapshot_path, input_hash, program)
+
+    if options.summary:
+        with stats_stage(stats, 'summary'):
+            print_summary(out, Summary(program, callables), options.format)
+        return
+    with stats_stage(stats, 'collect_refs'):
+        ref_table, ref_counts, _ = collect_refs(program)
+    if stats is not None:
+        stats.collect_program(program, ref_table, ref_counts)
+    budget = options.make_inline_budget(program)
+    # sharing subtrees needs the whole expanded program
+    if options.stream and options.cse_min_size is None and can_stream(program):
+        with stats_stage(stats, 'stream forms'):
+            wrapper = program.list[0]
+            if options.format != 'text':
+                emitter = JsonEmitter(out, callables, options.format == 'jsonl')
+                emitter.begin()
+                for form, _ in stream_top_level_forms(out, wrapper, ref_table, ref_counts, budget):
+                    emitter.emit_form(form)
+                emitter.end()
+                return
+            context = Context(tabstops=options.tabstops, fold=options.make_fold(), layout=options.make_layout(callables))
+            out.write('\'(' if wrapper.is_quote else '(')
+            walk(print_list_walker(out, wrapper, callables, Context(parent=context),
+                                   stream_top_level_forms(out, wrapper, ref_table, ref_counts, budget)))
+            out.write(')\n')
+            out.flush()
+        return
+    # inline budgets and --stats need the whole expanded program, so does a saved one
+    if budget is None and stats is None and not (options.snapshot is not None and options.snapshot_expanded):
+        print_expanded(out, LazyExpansion(ref_table, ref_counts).wrap(program), callables, options)
+        return
+    with stats_stage(stats, 'replace_refs'):
+        replaced_program = List(False)
+        replaced_program.list, did_replace = replace_refs(program.list, ref_table, ref_counts, budget=budget)
+    with stats_stage(stats, 'simplify_blocks'):
+        simplified_program = List(False)
+        simplified_program.list = simplify_blocks(replaced_program.list)
+    if options.snapshot is not None and options.snapshot_expanded:
+        with stats_stage(stats, 'save snapshot'):
+            save_snapshot(snapshot_path, input_hash, program, simplified_program, options.expansion_key())
+    print_expanded(out, simplified_program, callables, options, stats)
+    if stats is not None:
+        stats.collect_expansion(replaced_program, simplified_program, ref_table, ref_counts, did_replace)
+
+
+def print_expanded(out, simplified_program, callables, options, stats=None):
+    printed_program = simplified_program
+    if options.cse_min_size is not None:
+        with stats_stage(stats, 'share_subtrees'):
+            printed_program, shared = share_subtrees(simplified_program, options.cse_min_size)
+    with stats_stage(stats, 'print_list'):
+        if options.format != 'text':
+            emitter = JsonEmitter(out, callables, options.format == 'jsonl')
+            emitter.begin()
+            for form in top_level_forms(printed_program):
+                emitter.emit_form(form)
+                if emitter.jsonl:
+                    out.flush()
+            emitter.end()
+        else:
+            context = Context(tabstops=options.tabstops, fold=options.make_fold(), layout=options.make_layout(callables))
+            parallel = None
+            # the layout needs the column at which each list starts
+            if options.render_jobs is not None and options.render_jobs > 1 and context.layout is None:
+                parallel = ParallelRender(printed_program, callables, context, bool(out.color_prefixes), options.render_jobs)
+                if parallel.pool is not None:
+                    context.parallel = parallel
+            try:
+                print_list(out, printed_program, callables, context)
+                out.write('\n')
+                out.flush()
+            finally:
+                if parallel is not None:
+                    parallel.close()
+    if stats is not None and options.cse_min_size is not None:
+        stats.add('shared subtrees', shared)
+        stats.add('nodes after sharing', annotate(printed_program).size)
+
+
+class OperIndex:
+    """
+    Maps operator names, and the names and bases of their callables, to the
+    lists having them, in program order. Built in one pass over the parsed
+    program, before any expansion.
+    """
+    def __init__(self, program, callables):
+        self.lists = {}
+        self.op_counts = {}
+        self.parents = {}
+        # the top level forms are held by a single list without an operator
+        self.top = program
+        if len(program.list) == 1 and isinstance(program.list[0], List) and get_oper(program.list[0]) is None:
+            self.top = program.list[0]
+
+        stack = [program]
+        while stack:
+            item = stack.pop()
+            oper = get_oper(item)
+            if oper is not None:
+                self.op_counts[oper] = self.op_counts.get(oper, 0) + 1
+                self.lists.setdefault(oper, []).append(item)
+                node = callables.get(oper)
+                if node is not None:
+                    for name in (node.name, node.base):
+                        if name and name != oper:
+                            self.lists.setdefault(name, []).append(item)
+            for sub_item in reversed(item.list):
+                if isinstance(sub_item, List):
+                    self.parents[id(sub_item)] = item
+                    stack.append(sub_item)
+
+    def find(self, name):
+        return self.lists.get(name, [])
+
+    def ancestors(self, item):
+        """
+        The lists holding item, from the top level form down to its parent
+        """
+        result = []
+        parent = self.parents.get(id(item))
+        while parent is not None and parent is not self.top and id(parent) in self.parents:
+            result.append(parent)
+            parent = self.parents.get(id(parent))
+        result.reverse()
+        return result
+
+
+def describe_list(the_list):
+    ref_id = get_let_ref_id(the_list)
+    if ref_id is not None:
+        return '$%d' % ref_id
+    return get_oper(the_list) or ('\'(…)' if the_list.is_quote else '(…)')
+
+
+def print_query_hits(out, index, names, context_levels, table, ref_counts, callables, options):
+    """
+    Prints every list found by name, or its ancestor context_levels up, with
+    the path to it from its top level form. Only these lists are expanded.
+    """
+    fold = options.make_fold()
+    expansion = LazyExpansion(table, ref_counts)
+    for name in names:
+        hits = index.find(name)
+        if not hits:
+            print('%s: not found' % name, file=sys.stderr)
+        for hit in hits:
+            ancestors = index.ancestors(hit)
+            out.write_colored(COLOR_COMMENT, '# %s' % ' > '.join(describe_list(item) for item in ancestors + [hit]))
+            out.newline(0, False)
+            target = ancestors[-context_levels] if 0 < context_levels <= len(ancestors) else \
+                ancestors[0] if context_levels > len(ancestors) else hit
+            wrapper = List(False)
+            wrapper.list = expansion.simplify([target])
+            print_list(out, wrapper, callables,
+                       Context(tabstops=options.tabstops, fold=fold, layout=options.make_layout(callables)))
+            out.newline(0, False)
+            out.flush()
+
+
+def expand_text(text, options):
+    program = parse_buffer(text)
+    ref_table, ref_counts, _ = collect_refs(program)
+    replaced_program = List(False)
+    replaced_program.list, _ = replace_refs(program.list, ref_table, ref_counts,
+                                            budget=options.make_inline_budget(program))
+    simplified_program = List(False)
+    simplified_program.list = simplify_blocks(replaced_program.list)
+    return simplified_program
+
+
+class TreeHasher:
+    """
+    Merkle hashes of the lists of an expanded program that do not depend on
+    the $N numbering: a lambda argument is hashed as its position and how
+    many lambdas up it is bound, a kept let as the hash of its definition.
+    The hashes of the items of each list are kept for diffing.
+    """
+    def __init__(self, program):
+        self.item_hashes = {}
+        self.arg_slots = {}
+        self.let_definitions = {}
+        self.let_hashes = {}
+
+        seen = set()
+        stack = [program]
+        while stack:
+            item = stack.pop()
+            if id(item) in seen:
+                continue
+            seen.add(id(item))
+            ref_id = get_let_ref_id(item)
+            if ref_id is not None:
+                self.let_definitions[ref_id] = item
+            stack.extend(sub_item for sub_item in item.list if isinstance(sub_item, List))
+        walk(self.hash_walker(program, 0))
+
+    def items(self, the_list, depth):
+        return self.item_hashes[(id(the_list), depth)]
+
+    def hash_walker(self, the_list, depth):
+        key = (id(the_list), depth)
+        hashes = self.item_hashes.get(key)
+        if hashes is not None:
+            return hash((the_list.is_quote, *hashes))
+
+        items = the_list.list
+        let_ref_id = get_let_ref_id(the_list)
+        bound = []
+        if get_oper(the_list) == 'lambda' and len(items) > 1 and isinstance(items[1], List):
+            args = [item.alias for item in items[1].list if isinstance(item, Reference)]
+            bound = [(alias, self.arg_slots.get(alias)) for alias in args]
+            for pos, alias in enumerate(args):
+                self.arg_slots[alias] = (depth + 1, pos)
+
+        hashes = []
+        for pos, item in enumerate(items):
+            if isinstance(item, List):
+                sub_depth = depth + 1 if bound else depth
+                hashes.append((yield self.hash_walker(item, sub_depth)))
+            elif isinstance(item, Element):
+                hashes.append(hash((item.is_quote, item.value, item.is_quoted_str)))
+            elif let_ref_id is not None and pos == 1:
+                hashes.append(hash('let'))
+            elif item.alias in self.arg_slots:
+                slot_depth, arg_pos = self.arg_slots[item.alias]
+                hashes.append(hash(('arg', depth - slot_depth, arg_pos)))
+            elif item.alias in self.let_definitions and item.alias != let_ref_id:
+                let_hash = self.let_hashes.get(item.alias)
+                if let_hash is None:
+                    definition = self.let_definitions[item.alias]
+                    let_hash = yield self.hash_walker(definition, depth)
+                    self.let_hashes[item.alias] = let_hash
+                hashes.append(let_hash)
+            else:
+                hashes.append(hash('ref'))
+
+        for alias, slot in bound:
+            if slot is None:
+                del self.arg_slots[alias]
+            else:
+                self.arg_slots[alias] = slot
+        self.item_hashes[key] = hashes
+        return hash((the_list.is_quote, *hashes))
+
+
+class PlanDiff:
+    """
+    Prints the differing items of two expanded programs. Runs of items are
+    aligned by their TreeHasher hashes, and pairs of lists with the same
+    operator are diffed further down instead of being printed whole.
+    """
+    def __init__(self, out, old, new, callables, options):
+        self.out = out
+        self.old_hasher = TreeHasher(old)
+        self.new_hasher = TreeHasher(new)
+        self.callables = callables
+        self.options = options
+        self.path = []
+        # a changed let changes the hashes of all its uses, but the change
+        # is printed once, where the let is
+        self.let_pairs = {}
+
+    def print_hunk(self, removed, added):
+        out = self.out
+        out.write_colored(COLOR_COMMENT, '@@ %s @@' % (' > '.join(self.path) or 'top level'))
+        out.newline(0, False)
+        for marker, color, items in (('-', COLOR_REMOVED, removed), ('+', COLOR_ADDED, added)):
+            for item in items:
+                text = io.StringIO()
+                item_out = Output(text, bool(out.color_prefixes))
+                wrapper = List(False)
+                wrapper.list = [item]
+                print_list(item_out, wrapper, self.callables,
+                           Context(tabstops=self.options.tabstops, fold=self.options.make_fold(),
+                                   layout=self.options.make_layout(self.callables)))
+                item_out.flush()
+                for line in text.getvalue().rstrip('\n').split('\n'):
+                    out.write_colored(color, marker)
+                    out.write(line)
+                    out.newline(0, False)
+
+    def pair_lets(self, old_items, new_items):
+        for old_item, new_item in zip(old_items, new_items):
+            old_ref_id = get_let_ref_id(old_item)
+            new_ref_id = get_let_ref_id(new_item)
+            if old_ref_id is not None and new_ref_id is not None:
+                self.let_pairs[old_ref_id] = new_ref_id
+
+    def diff_walker(self, old, new, depths):
+        old_depth, new_depth = depths
+        if get_oper(old) == 'lambda':
+            depths = (old_depth + 1, new_depth + 1)
+        matcher = difflib.SequenceMatcher(None, self.old_hasher.items(old, old_depth),
+                                          self.new_hasher.items(new, new_depth), autojunk=False)
+        differs = False
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                self.pair_lets(old.list[i1:i2], new.list[j1:j2])
+                continue
+            if tag == 'replace' and i2 - i1 == j2 - j1:
+                for old_item, new_item in zip(old.list[i1:i2], new.list[j1:j2]):
+                    if isinstance(old_item, List) and isinstance(new_item, List) and \
+                            old_item.is_quote == new_item.is_quote and get_oper(old_item) == get_oper(new_item):
+                        self.pair_lets([old_item], [new_item])
+                        self.path.append(describe_list(old_item))
+                        differs |= yield self.diff_walker(old_item, new_item, depths)
+                        self.path.pop()
+                    elif isinstance(old_item, Reference) and isinstance(new_item, Reference) and \
+                            self.let_pairs.get(old_item.alias) == new_item.alias:
+                        continue
+                    else:
+                        self.print_hunk([old_item], [new_item])
+                        differs = True
+                continue
+            self.print_hunk(old.list[i1:i2], new.list[j1:j2])
+            differs = True
+        return differs
+
+
+def diff(old_text, new_text, out, callables, options):
+    old = expand_text(old_text, options)
+    new = expand_text(new_text, options)
+    plan_diff = PlanDiff(out, old, new, callables, options)
+    # paths start at the top level forms
+    if len(old.list) == 1 == len(new.list) and isinstance(old.list[0], List) and isinstance(new.list[0], List):
+        return walk(plan_diff.diff_walker(old.list[0], new.list[0], (0, 0)))
+    return walk(plan_diff.diff_walker(old, new, (0, 0)))
+
+
+def print_op_counts(out, op_counts):
+    for oper, count in sorted(op_counts.items(), key=lambda item: (-item[1], item[0])):
+        out.write('%8d  ' % count)
+        out.write_colored(get_oper_color(oper), oper)
+        out.newline(0, False)
+
+
+def query(text, out, callables, args, options):
+    program = parse_buffer(text)
+    index = OperIndex(program, callables)
+    if args.count_ops:
+        print_op_counts(out, index.op_counts)
+    if args.find:
+        table, ref_counts, _ = collect_refs(program)
+        print_query_hits(out, index, args.find, args.context, table, ref_counts, callables, options)
+
+
+class Summary:
+    """
+    Plan statistics for --summary, counted in one pass over the parsed
+    program, before and instead of any expansion
+    """
+    STAGE_OPERATORS = ('DqStage', 'DqPhyStage')
+    STAGE_BASE = 'TDqStageBase'
+
+    def __init__(self, program, callables, top=10):
+        self.op_counts = {}
+        self.lists = 0
+        self.atoms = 0
+        self.max_depth = 0
+        self.stages = 0
+        self.strings = 0
+        self.string_bytes = 0
+        self.let_refs = []
+        ref_counts = {}
+        string_sizes = {}
+
+        # the top level forms are at depth 1 and are the subtrees measured
+        root = program
+        if len(program.list) == 1 and isinstance(program.list[0], List) and get_oper(program.list[0]) is None:
+            root = program.list[0]
+        forms = [item for item in root.list if isinstance(item, List)]
+        form_sizes = [0] * len(forms)
+        self.atoms = len(root.list) - len(forms)
+
+        stack = [(form, 1, index) for index, form in reversed(list(enumerate(forms)))]
+        while stack:
+            item, depth, form = stack.pop()
+            self.lists += 1
+            form_sizes[form] += 1
+            if depth > self.max_depth:
+                self.max_depth = depth
+            oper = get_oper(item)
+            let_ref_id = get_let_ref_id(item)
+            if oper is not None:
+                self.op_counts[oper] = self.op_counts.get(oper, 0) + 1
+                node = callables.get(oper)
+                if oper in self.STAGE_OPERATORS or (node is not None and node.base == self.STAGE_BASE):
+                    self.stages += 1
+            if let_ref_id is not None:
+                self.let_refs.append(let_ref_id)
+            for pos, sub_item in enumerate(item.list):
+                if isinstance(sub_item, List):
+                    continue
+                self.atoms += 1
+                form_sizes[form] += 1
+                if isinstance(sub_item, Reference):
+                    # the name of a let is not a use of it
+                    if not (pos == 1 and let_ref_id is not None):
+                        ref_counts[sub_item.alias] = ref_counts.get(sub_item.alias, 0) + 1
+                elif sub_item.is_quoted_str:
+                    size = string_sizes.get(sub_item.value)
+                    if size is None:
+                        size = string_sizes[sub_item.value] = len(sub_item.value.encode('utf-8'))
+                    self.strings += 1
+                    self.string_bytes += size
+            for sub_item in reversed(item.list):
+                if isinstance(sub_item, List):
+                    stack.append((sub_item, depth + 1, form))
+
+        # uses per let, in buckets 0, 1, 2, 3-4, 5-8, ...
+        self.fan_out = {}
+        for ref_id in self.let_refs:
+            uses = ref_counts.get(ref_id, 0)
+            bucket = uses if uses <= 2 else 1 << (uses - 1).bit_length()
+            self.fan_out[bucket] = self.fan_out.get(bucket, 0) + 1
+        self.max_fan_out = max(((ref_counts.get(ref_id, 0), ref_id) for ref_id in self.let_refs), default=None)
+        self.biggest = sorted(((size, self.describe_form(form)) for size, form in zip(form_sizes, forms)),
+                              key=lambda item: -item[0])[:top]
+
+    @staticmethod
+    def describe_form(form):
+        description = describe_list(form)
+        if get_let_ref_id(form) is not None and isinstance(form.list[2], List):
+            description += ' ' + describe_list(form.list[2])
+        return description
+
+    @staticmethod
+    def bucket_name(bucket):
+        return str(bucket) if bucket <= 2 else '%d-%d' % (bucket // 2 + 1, bucket)
+
+    def as_dict(self):
+        return {
+            'lists': self.lists,
+            'atoms': self.atoms,
+            'max_depth': self.max_depth,
+            'stages': self.stages,
+            'lets': len(self.let_refs),
+            'strings': self.strings,
+            'string_bytes': self.string_bytes,
+            'let_uses': {self.bucket_name(bucket): count for bucket, count in sorted(self.fan_out.items())},
+            'max_let_uses': {'ref': self.max_fan_out[1], 'uses': self.max_fan_out[0]} if self.max_fan_out else None,
+            'biggest_forms': [{'form': description, 'nodes': size} for size, description in self.biggest],
+            'operators': self.op_counts,
+        }
+
+
+def print_summary(out, summary, format):
+    if format != 'text':
+        out.write(json.dumps(summary.as_dict(), indent=2 if format == 'json' else None))
+        out.newline(0, False)
+        return
+    for name, value in (('lists', summary.lists), ('atoms', summary.atoms), ('max depth', summary.max_depth),
+                        ('stages', summary.stages), ('lets', len(summary.let_refs)),
+                        ('string literals', summary.strings), ('string bytes', summary.string_bytes)):
+        out.write('%-20s %12d' % (name, value))
+        out.newline(0, False)
+    for bucket, count in sorted(summary.fan_out.items()):
+        out.write('%-20s %12d' % ('lets used %s' % summary.bucket_name(bucket), count))
+        out.newline(0, False)
+    if summary.max_fan_out is not None:
+        out.write('%-20s %12s' % ('most used let', '$%d x%d' % (summary.max_fan_out[1], summary.max_fan_out[0])))
+        out.newline(0, False)
+    out.write_colored(COLOR_COMMENT, '# biggest top level forms, nodes')
+    out.newline(0, False)
+    for size, description in summary.biggest:
+        out.write('%8d  %s' % (size, description))
+        out.newline(0, False)
+    out.write_colored(COLOR_COMMENT, '# operators')
+    out.newline(0, False)
+    print_op_counts(out, summary.op_counts)
+
+
+class BatchItem:
+    def __init__(self, name, path, offset=None):
+        self.name = name
+        self.path = path
+        self.offset = offset
+
+    def read(self, jsonl_key):
+        if self.offset is None:
+            return read_input(self.path)
+        with open(self.path, 'rb') as inf:
+            inf.seek(self.offset)
+            record = json.loads(inf.readline())
+        if isinstance(record, dict):
+            if jsonl_key not in record:
+                raise Exception("record has no %r field" % jsonl_key)
+            record = record[jsonl_key]
+        if not isinstance(record, str):
+            raise Exception("plan in %s is not a string" % self.name)
+        return record
+
+
+def list_batch_items(spec):
+    if spec.endswith('.jsonl') and os.path.isfile(spec):
+        stem = os.path.splitext(os.path.basename(spec))[0]
+        with open(spec, 'rb') as inf:
+            offset = 0
+            for lineno, line in enumerate(inf, 1):
+                if line.strip():
+                    yield BatchItem('%s.%d' % (stem, lineno), spec, offset)
+                offset += len(line)
+    elif os.path.isdir(spec):
+        for name in sorted(os.listdir(spec)):
+            path = os.path.join(spec, name)
+            if os.path.isfile(path):
+                yield BatchItem(name, path)
+    else:
+        paths = sorted(glob.glob(spec))
+        if not paths:
+            raise Exception("no plans match %s" % spec)
+        for path in paths:
+            if path.endswith('.jsonl'):
+                yield from list_batch_items(path)
+            else:
+                yield BatchItem(os.path.basename(path), path)
+
+
+batch_state = {}
+
+
+def init_batch_worker(callables, options, use_color, jsonl_key, output_dir):
+    batch_state.update(callables=callables, options=options, use_color=use_color,
+                       jsonl_key=jsonl_key, output_dir=output_dir)
+
+
+def render_batch_item(item):
+    """
+    Runs in a batch worker. Returns (rendered text or None, error or None),
+    the text is None when the plan was written to the output directory.
+    """
+    try:
+        text = item.read(batch_state['jsonl_key'])
+        buf = io.StringIO()
+        out = Output(buf, batch_state['use_color'])
+        pretty_print(text, out, batch_state['callables'], batch_state['options'])
+        out.flush()
+        if batch_state['output_dir'] is None:
+            return buf.getvalue(), None
+        with open(os.path.join(batch_state['output_dir'], item.name + '.txt'), 'wt') as outf:
+            outf.write(buf.getvalue())
+        return None, None
+    except Exception as e:
+        return None, '%s: %s' % (item.name, e)
+
+
+def run_batch(args, callables):
+    items = []
+    for spec in args.batch:
+        items += list_batch_items(spec)
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+        use_color = args.color == 'always'
+    else:
+        use_color = stream_supports_color(sys.stdout, args.color)
+
+    failed = 0
+    initargs = (callables, Options.from_args(args), use_color, args.jsonl_key, args.output_dir)
+    with multiprocessing.Pool(args.jobs, initializer=init_batch_worker, initargs=initargs) as pool:
+        for item, (text, error) in zip(items, pool.imap(render_batch_item, items)):
+            if error is not None:
+                print(error, file=sys.stderr)
+                failed += 1
+            elif text is not None:
+                sys.stdout.write('==> %s <==\n' % item.name)
+                sys.stdout.write(text)
+    if failed:
+        print('%d of %d plans failed' % (failed, len(items)), file=sys.stderr)
+        return 1
+    return 0
+
+
+# a request is the size of its payload and the payload, a response also
+# starts with a status: 0 for the rendered plan, 1 for an error message
+SERVE_REQUEST = struct.Struct('>I')
+SERVE_RESPONSE = struct.Struct('>BI')
+
+
+def read_frame(stream):
+    header = stream.read(SERVE_REQUEST.size)
+    if not header:
+        return None
+    if len(header) < SERVE_REQUEST.size:
+        raise Exception("truncated frame header")
+    size, = SERVE_REQUEST.unpack(header)
+    payload = stream.read(size)
+    if len(payload) < size:
+        raise Exception("truncated frame")
+    return payload
+
+
+def write_frame(stream, status, payload):
+    stream.write(SERVE_RESPONSE.pack(status, len(payload)) + payload)
+    stream.flush()
+
+
+def render_request(payload):
+    """
+    Runs in a server worker. The payload is either a plan or a JSON object
+    with the "plan" and optionally "options", overriding fields of Options,
+    and "color". Returns (status, response payload).
+    """
+    try:
+        options = batch_state['options']
+        use_color = batch_state['use_color']
+        text = payload.decode('utf-8')
+        if text.lstrip().startswith('{'):
+            request = json.loads(text)
+            text = request['plan']
+            overrides = dict(request.get('options', {}))
+            if overrides.get('only') is not None:
+                overrides['only'] = set(overrides['only'])
+            options = Options(**dict(vars(options), **overrides))
+            use_color = request.get('color', use_color)
+        buf = io.StringIO()
+        out = Output(buf, use_color)
+        pretty_print(text, out, batch_state['callables'], options)
+        out.flush()
+        return 0, buf.getvalue().encode('utf-8')
+    except Exception as e:
+        return 1, str(e).encode('utf-8')
+
+
+def serve_stream(pool, inf, outf):
+    # requests are rendered concurrently, responses go out in request order
+    results = queue.Queue()
+
+    def write_results():
+        while True:
+            result = results.get()
+            if result is None:
+                return
+            write_frame(outf, *result.get())
+
+    writer = threading.Thread(target=write_results)
+    writer.start()
+    try:
+        while True:
+            payload = read_frame(inf)
+            if payload is None:
+                break
+            results.put(pool.apply_async(render_request, (payload,)))
+    finally:
+        results.put(None)
+        writer.join()
+
+
+class ServeHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                payload = read_frame(self.rfile)
+            except Exception as e:
+                print('%s' % e, file=sys.stderr)
+                return
+            if payload is None:
+                return
+            result = self.server.pool.apply(render_request, (payload,))
+            try:
+                write_frame(self.wfile, *result)
+            except OSError:
+                # the client went away
+                return
+
+
+def serve_socket(pool, path):
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+    with socketserver.ThreadingUnixStreamServer(path, ServeHandler) as server:
+        server.daemon_threads = True
+        server.pool = pool
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+
+
+def serve(args, callables):
+    initargs = (callables, Options.from_args(args), args.color == 'always', None, None)
+    with multiprocessing.Pool(args.jobs, initializer=init_batch_worker, initargs=initargs) as pool:
+        if args.serve == '-':
+            try:
+                serve_stream(pool, sys.stdin.buffer, sys.stdout.buffer)
+            except Exception as e:
+                print('%s' % e, file=sys.stderr)
+                return 1
+        else:
+            serve_socket(pool, args.serve)
+    return 0
+
+
+REPO_NODE_FILES = [
+    'ydb/library/yql/dq/expr_nodes/dq_expr_nodes.json',
+    'ydb/core/kqp/expr_nodes/kqp_expr_nodes.json',
+    'yql/essentials/core/expr_nodes/yql_expr_nodes.json',
+]
+
+CALLABLES_CACHE_VERSION = 1
 
-    tabstops = args.tabstops
 
+def get_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'pretty-ast')
+
+
+def get_callables_cache_path(node_files):
+    key = [CALLABLES_CACHE_VERSION]
+    for node_file in node_files:
+        st = os.stat(node_file)
+        key.append((os.path.abspath(node_file), st.st_mtime_ns, st.st_size))
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    return os.path.join(get_cache_dir(), 'callables-%s.pickle' % digest)
+
+
+def build_callables(node_files):
     node_descrs = {}
-    node_files = []
-    if args.repo:
-        import os.path
-        node_files += [os.path.join(args.repo, path) for path in [
-            'ydb/library/yql/dq/expr_nodes/dq_expr_nodes.json',
-            'ydb/core/kqp/expr_nodes/kqp_expr_nodes.json',
-            'yql/essentials/core/expr_nodes/yql_expr_nodes.json',
-        ]]
-    node_files += args.nodes
     for node_file in node_files:
         with open(node_file, 'rt') as inf:
             node_descrs.update(parse_node_file(inf))
@@ -637,12 +2510,229 @@ if __name__ == '__main__':
     inherit_children(node_descrs)
     callables = build_callable_index(node_descrs)
     # print('%d callables' % len(callables), file=sys.stderr)
+    return callables
 
-    program = parse(sys.stdin)
-    ref_table, ref_counts, _ = collect_refs(program)
-    replaced_program = List(False)
-    replaced_program.list, _ = replace_refs(program.list, ref_table, ref_counts)
-    simplified_program = List(False)
-    simplified_program.list = simplify_blocks(replaced_program.list)
-    print_list(sys.stdout, simplified_program, callables, Context(tabstops=tabstops))
-    print()
+
+def load_callables(node_files, use_cache=True, rebuild_cache=False):
+    """
+    Returns the callables index for the node files. The index is cached on disk,
+    keyed by the paths, mtimes and sizes of the node files.
+    """
+    if not node_files or not use_cache:
+        return build_callables(node_files)
+
+    cache_path = get_callables_cache_path(node_files)
+    if not rebuild_cache:
+        try:
+            with open(cache_path, 'rb') as inf:
+                cached = pickle.load(inf)
+            return {callable: NodeDescr(*descr) for callable, descr in cached.items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print('Ignoring broken callables cache %s: %s' % (cache_path, e), file=sys.stderr)
+
+    callables = build_callables(node_files)
+    cached = {callable: (node.name, node.base, node.match_callable, node.children_names) for callable, node in callables.items()}
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        with open(tmp_path, 'wb') as outf:
+            pickle.dump(cached, outf, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print('Cannot write callables cache %s: %s' % (cache_path, e), file=sys.stderr)
+    return callables
+
+
+SNAPSHOT_MAGIC = b'PASNAP01'
+# magic, hash of the input text, Options.expansion_key() of the expanded program or zeros
+SNAPSHOT_HEADER = struct.Struct('8s20s20s')
+
+
+def encode_tree(root, atoms, atom_codes, lists, list_codes):
+    """
+    Appends the lists of root to a flat table, children before their parents
+    and shared lists once, so that marshal never has to recurse into a deep
+    program. Lists are tuples of is_quote and item codes: an index in lists,
+    or -1 - an index in atoms. Returns the code of root.
+    """
+    stack = [(root, False)]
+    while stack:
+        item, children_done = stack.pop()
+        if id(item) in list_codes:
+            continue
+        if not children_done:
+            stack.append((item, True))
+            for sub_item in item.list:
+                if isinstance(sub_item, List) and id(sub_item) not in list_codes:
+                    stack.append((sub_item, False))
+            continue
+        codes = [item.is_quote]
+        for sub_item in item.list:
+            if isinstance(sub_item, List):
+                codes.append(list_codes[id(sub_item)])
+                continue
+            code = atom_codes.get(id(sub_item))
+            if code is None:
+                code = -1 - len(atoms)
+                if isinstance(sub_item, Reference):
+                    atoms.append(sub_item.alias)
+                else:
+                    atoms.append((sub_item.is_quote, sub_item.value, sub_item.is_quoted_str))
+                atom_codes[id(sub_item)] = code
+            codes.append(code)
+        list_codes[id(item)] = len(lists)
+        lists.append(tuple(codes))
+    return list_codes[id(root)]
+
+
+def decode_tree(atoms, lists):
+    atoms = [Reference(atom) if isinstance(atom, int) else Element(*atom) for atom in atoms]
+    decoded = []
+    for codes in lists:
+        l = List(codes[0])
+        l.list = [decoded[code] if code >= 0 else atoms[-1 - code] for code in itertools.islice(codes, 1, None)]
+        decoded.append(l)
+    return decoded
+
+
+def save_snapshot(path, input_hash, program, expanded_program=None, expansion_key=bytes(20)):
+    atoms, atom_codes, lists, list_codes = [], {}, [], {}
+    program_code = encode_tree(program, atoms, atom_codes, lists, list_codes)
+    expanded_code = None
+    if expanded_program is not None:
+        expanded_code = encode_tree(expanded_program, atoms, atom_codes, lists, list_codes)
+    else:
+        expansion_key = bytes(20)
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as outf:
+            outf.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, input_hash, expansion_key))
+            marshal.dump((atoms, lists, program_code, expanded_code), outf)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print('Cannot write snapshot %s: %s' % (path, e), file=sys.stderr)
+
+
+def load_snapshot(path, input_hash):
+    """
+    Returns the program, the expanded program or None and its expansion key
+    if path holds a snapshot of the input with input_hash, None otherwise
+    """
+    try:
+        with open(path, 'rb') as inf, mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if len(data) < SNAPSHOT_HEADER.size:
+                return None
+            magic, snapshot_hash, expansion_key = SNAPSHOT_HEADER.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC or snapshot_hash != input_hash:
+                return None
+            with memoryview(data) as view, view[SNAPSHOT_HEADER.size:] as payload:
+                atoms, lists, program_code, expanded_code = marshal.loads(payload)
+    except (FileNotFoundError, ValueError):
+        # missing or empty file
+        return None
+    except Exception as e:
+        print('Ignoring broken snapshot %s: %s' % (path, e), file=sys.stderr)
+        return None
+    decoded = decode_tree(atoms, lists)
+    expanded_program = decoded[expanded_code] if expanded_code is not None else None
+    return decoded[program_code], expanded_program, expansion_key
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('inputs', nargs='*', metavar='INPUT',
+                           help='plan files printed one after another, .gz, .xz and .zst ones are decompressed; '
+                                'stdin by default or for -')
+    argparser.add_argument('-n', '--nodes', default=[], action='append')
+    argparser.add_argument('-r', '--repo', default=None)
+    argparser.add_argument('-t', '--tabstops', action='store_true', default=False)
+    argparser.add_argument('--color', choices=['auto', 'always', 'never'], default='auto')
+    argparser.add_argument('--no-cache', action='store_true', default=False,
+                           help='do not use the on-disk cache of the callables index')
+    argparser.add_argument('--rebuild-cache', action='store_true', default=False,
+                           help='rebuild the cached callables index even if it is up to date')
+    argparser.add_argument('-s', '--stream', action='store_true', default=False,
+                           help='expand, simplify and print top level forms one at a time')
+    argparser.add_argument('--max-inline-size', type=int, default=None,
+                           help='do not inline macros larger than this many nodes at more than one place')
+    argparser.add_argument('--max-inline-growth', type=float, default=None,
+                           help='let inlining grow the output by at most this fraction of the input node count')
+    argparser.add_argument('--cse', type=int, default=None, metavar='MIN_SIZE',
+                           help='share equal subtrees in memory and print repeated ones of at least MIN_SIZE nodes once, as new lets')
+    argparser.add_argument('--max-depth', type=int, default=None,
+                           help='fold lists nested deeper than this, the top level forms are level 1')
+    argparser.add_argument('--fold-larger-than', type=int, default=None, metavar='N',
+                           help='fold lists of more than N nodes')
+    argparser.add_argument('--only', default=None, metavar='OPER[,OPER]',
+                           help='fold lists that neither are nor contain one of these operators')
+    argparser.add_argument('--find', default=[], action='append', metavar='NAME',
+                           help='print only the lists with this operator, callable name or callable base, expanded')
+    argparser.add_argument('--context', type=int, default=0, metavar='N',
+                           help='with --find print the list N levels above each found one')
+    argparser.add_argument('--summary', action='store_true', default=False,
+                           help='print operator counts, nesting depth, let uses, string sizes and the biggest '
+                                'top level forms instead of the program; --format json or jsonl prints them as JSON')
+    argparser.add_argument('--count-ops', action='store_true', default=False,
+                           help='print how many times each operator occurs in the input')
+    argparser.add_argument('--snapshot', nargs='?', const='', default=None, metavar='FILE',
+                           help='load the parsed program from a binary snapshot made from the same input, or save one; '
+                                'kept in the cache directory by default')
+    argparser.add_argument('--snapshot-expanded', action='store_true', default=False,
+                           help='also keep the expanded program in the snapshot')
+    argparser.add_argument('--diff', nargs=2, default=None, metavar=('OLD', 'NEW'),
+                           help='print only the parts of the expanded NEW program that differ from OLD')
+    argparser.add_argument('-f', '--format', choices=['text', 'json', 'jsonl'], default='text',
+                           help='print the expanded program as text, as a JSON array of top level forms, '
+                                'or as one JSON object per top level form and line')
+    argparser.add_argument('--render-jobs', type=int, default=None, metavar='N',
+                           help='render large independent subtrees in N worker processes')
+    argparser.add_argument('-w', '--width', type=int, default=None, metavar='COLUMNS',
+                           help='break lines by the width of the lists instead of by their operators, '
+                                'ignores --render-jobs')
+    argparser.add_argument('--stats', action='store_true', default=False,
+                           help='print per stage timings and memory, node counts and expansion details to stderr')
+    argparser.add_argument('-b', '--batch', default=[], action='append',
+                           help='pretty-print many plans: a directory, a glob or a .jsonl file with one plan per line')
+    argparser.add_argument('--jsonl-key', default='ast',
+                           help='field holding the plan in .jsonl records that are objects')
+    argparser.add_argument('-o', '--output-dir', default=None,
+                           help='write each batch plan to its own file instead of stdout')
+    argparser.add_argument('--serve', default=None, metavar='SOCKET',
+                           help='keep running and render plans sent over this Unix socket, or over stdin/stdout '
+                                'for -, as frames of a 4 byte big endian size and the payload')
+    argparser.add_argument('-j', '--jobs', type=int, default=None,
+                           help='number of worker processes for batch and server modes')
+    args = argparser.parse_args()
+
+    node_files = []
+    if args.repo:
+        node_files += [os.path.join(args.repo, path) for path in REPO_NODE_FILES]
+    node_files += args.nodes
+    stats = Stats() if args.stats else None
+    with stats_stage(stats, 'load nodes'):
+        callables = load_callables(node_files, use_cache=not args.no_cache, rebuild_cache=args.rebuild_cache)
+
+    if args.batch:
+        sys.exit(run_batch(args, callables))
+    if args.serve is not None:
+        sys.exit(serve(args, callables))
+
+    out = Output(sys.stdout, stream_supports_color(sys.stdout, args.color))
+    if args.diff:
+        texts = [read_input(path) for path in args.diff]
+        differs = diff(texts[0], texts[1], out, callables, Options.from_args(args))
+        out.flush()
+        sys.exit(1 if differs else 0)
+    for path in args.inputs or ['-']:
+        with stats_stage(stats, 'read input'):
+            text = sys.stdin.buffer.read() if path == '-' else read_input(path)
+        if args.find or args.count_ops:
+            query(text, out, callables, args, Options.from_args(args))
+        else:
+            pretty_print(text, out, callables, Options.from_args(args), stats)
+        out.flush()
+    if stats is not None:
+        stats.report(sys.stderr)